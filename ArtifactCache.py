@@ -0,0 +1,166 @@
+import hashlib
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+"""
+Usage:
+    cache = ArtifactCache('.livelens_cache', max_bytes=2 * 1024**3)
+    keys = cache.keys_for('Images/459_s_199_F.jpg')
+    cached = cache.get(keys['weight_animals'])
+    if cached is None:
+        animal_weights = ...
+        cache.put(keys['weight_animals'], animal_weights=animal_weights)
+    else:
+        animal_weights = cached['animal_weights']
+
+Entries are content addressed: a key hashes the image bytes together with the contents of the
+files the stage depends on. Editing mtx_05zoom, yolov8m-seg.pt or weights.03.hdf5 changes the
+keys, so stale entries are never read again and age out through the LRU eviction.
+
+weight_animals holds one weight per detected animal, the Backend and BatchPipeline both read
+and write it.
+"""
+
+# Bump when the arrays stored for a stage change, older entries then simply miss
+FORMAT_VERSION = '4'
+
+# Files each cached stage depends on, on top of the image itself
+STAGE_DEPENDENCIES = {
+    'undistorted': ('mtx_05zoom', 'dist_05zoom'),
+    'segmented': ('mtx_05zoom', 'dist_05zoom', 'yolov8m-seg.pt'),
+    'weight_animals': ('mtx_05zoom', 'dist_05zoom', 'yolov8m-seg.pt', 'weights.03.hdf5'),
+}
+
+
+def stage_dependencies(segmentation_model='yolov8m-seg.pt', predictor_model='weights.03.hdf5',
+                       calibration=('mtx_05zoom', 'dist_05zoom'), weight_estimator=None):
+    # STAGE_DEPENDENCIES for other model files, e.g. exported ONNX or OpenVINO models. Weights
+    # from a GeometricWeightEstimator also depend on its regression file, predictor_model is
+    # None when the estimator runs without the ResNet fallback
+    weight_models = tuple(path for path in (predictor_model, weight_estimator) if path)
+    return {
+        'undistorted': tuple(calibration),
+        'segmented': (*calibration, segmentation_model),
+        'weight_animals': (*calibration, segmentation_model, *weight_models),
+    }
+
+
+def hash_file(path, chunk_size=1 << 20):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class ArtifactCache:
+    def __init__(self, cache_dir='.livelens_cache', max_bytes=2 * 1024**3, stage_dependencies=STAGE_DEPENDENCIES):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.stage_dependencies = stage_dependencies
+        # Dependency file hashes, keyed by path and reused while (mtime, size) is unchanged
+        self._file_hashes = {}
+        self._lock = threading.Lock()
+        # Entries are written in the background so callers do not wait on the disk
+        self._writer = ThreadPoolExecutor(max_workers=1)
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def fingerprint(self, path):
+        if os.path.isdir(path):
+            # A model directory, e.g. an OpenVINO export, hashes the files it contains
+            names = sorted(os.listdir(path))
+            digest = hashlib.sha256()
+            for name in names:
+                digest.update(f"{name}:{self.fingerprint(os.path.join(path, name))}".encode())
+            return digest.hexdigest()
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return 'missing'
+        signature = (stat.st_mtime_ns, stat.st_size)
+        with self._lock:
+            cached = self._file_hashes.get(path)
+        if cached is not None and cached[0] == signature:
+            return cached[1]
+        file_hash = hash_file(path)
+        with self._lock:
+            self._file_hashes[path] = (signature, file_hash)
+        return file_hash
+
+    """
+        keys_for returns the cache key of every stage for one image file
+    """
+    def keys_for(self, image_path):
+        image_hash = hash_file(image_path)
+        keys = {}
+        for stage, dependencies in self.stage_dependencies.items():
+            digest = hashlib.sha256(image_hash.encode())
+            digest.update(f"{stage}:{FORMAT_VERSION}".encode())
+            for dependency in dependencies:
+                digest.update(self.fingerprint(dependency).encode())
+            keys[stage] = digest.hexdigest()
+        return keys
+
+    def entry_path(self, key):
+        return os.path.join(self.cache_dir, key + '.npz')
+
+    def get(self, key):
+        path = self.entry_path(key)
+        try:
+            with np.load(path) as entry:
+                artifacts = {name: entry[name] for name in entry.files}
+        except (OSError, ValueError):
+            return None
+        try:
+            # The modification time doubles as the LRU access time
+            os.utime(path)
+        except OSError:
+            pass
+        return artifacts
+
+    def put(self, key, **artifacts):
+        self._writer.submit(self._write, key, artifacts)
+
+    def _write(self, key, artifacts):
+        path = self.entry_path(key)
+        temp_path = f"{path}.{threading.get_ident()}.tmp"
+        try:
+            with open(temp_path, 'wb') as f:
+                np.savez(f, **artifacts)
+            # Readers never see a half written entry
+            os.replace(temp_path, path)
+            self.evict()
+        except Exception as e:
+            print(f"Failed to cache {key}: {e}")
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+
+    def evict(self):
+        entries = []
+        total = 0
+        for entry in os.scandir(self.cache_dir):
+            if entry.name.endswith('.npz'):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+                total += stat.st_size
+        # Remove the least recently used entries until the cache fits its budget
+        entries.sort()
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+                total -= size
+            except OSError:
+                pass
+
+    def clear(self):
+        for entry in os.scandir(self.cache_dir):
+            if entry.name.endswith('.npz'):
+                os.remove(entry.path)
+
+    def shutdown(self):
+        self._writer.shutdown(wait=True)
+
@@ -0,0 +1,260 @@
+import argparse
+import csv
+import glob
+import json
+import os
+import queue
+import threading
+from functools import partial
+import numpy as np
+from SegmentationModel import SegmentationModel
+from DistortionCorrection import DistortionCorrection
+from CowWeightPredictor import CowWeightPredictor
+from CowPipeline import CowPipeline, parse_image_name
+from ArtifactCache import ArtifactCache, stage_dependencies
+from InferenceBackends import PREDICTOR_BACKENDS
+from StageWorkers import StageWorkers, WorkerSegmentationModel, WorkerWeightPredictor
+from ThreadBudget import load_thread_budget
+from GeometricWeightEstimator import GeometricWeightEstimator
+
+"""
+Usage:
+    python BatchPipeline.py "Images/*.jpg" --output results.csv
+    python BatchPipeline.py Images --output results.jsonl
+
+Runs decode -> undistort -> segment -> predict headless. Every stage has its own thread and the
+stages are joined by bounded queues, so decoding and undistorting image N+1 overlaps the
+inference on image N without ever holding more than a few frames in memory. Segmented frames
+that are ready together go through CowWeightPredictor as one batch.
+
+Every detected animal is weighed, like in the demo: predicted_weight_kg (and error_kg) is the
+first animal, animal_weights_kg lists all of them in detection order. Images without a cow get an
+error instead of a weight.
+
+With --weight-estimator the frames whose geometric estimate is trusted skip CowWeightPredictor,
+with --no-fallback as well the ResNet is not even loaded (see GeometricWeightEstimator.py).
+"""
+
+# Marks the end of the stream on a stage queue
+_END = object()
+
+OUTPUT_FIELDS = ['image', 'animal_id', 'sex', 'actual_weight_kg', 'predicted_weight_kg', 'error_kg',
+                 'animal_count', 'animal_weights_kg', 'error']
+
+
+def expand_image_paths(source):
+    if os.path.isdir(source):
+        paths = []
+        for pattern in ('*.jpg', '*.JPG', '*.jpeg', '*.png'):
+            paths.extend(glob.glob(os.path.join(source, pattern)))
+        return sorted(set(paths))
+    return sorted(glob.glob(source))
+
+
+class BatchPipeline:
+    def __init__(self, pipeline, queue_size=4, batch_size=16, cache=None):
+        self.pipeline = pipeline
+        self.queue_size = queue_size
+        self.batch_size = batch_size
+        # Optional ArtifactCache, images with cached weights are not decoded at all
+        self.cache = cache
+
+    """
+        run streams image_paths through the pipeline and yields one result dict per image, in order
+    """
+    def run(self, image_paths):
+        decoded = queue.Queue(maxsize=self.queue_size)
+        undistorted = queue.Queue(maxsize=self.queue_size)
+        segmented = queue.Queue(maxsize=self.queue_size)
+        stop = threading.Event()
+        weight_keys = {} # Cache key of the animal weights for each image path
+
+        def put(stage_queue, item):
+            # Give up waiting on a full queue once the consumer has stopped
+            while not stop.is_set():
+                try:
+                    stage_queue.put(item, timeout=0.1)
+                    return
+                except queue.Full:
+                    continue
+
+        def decode_stage():
+            for path in image_paths:
+                if stop.is_set():
+                    break
+                record = self.new_record(path)
+                try:
+                    if self.cache is not None:
+                        weight_key = self.cache.keys_for(path)['weight_animals']
+                        cached = self.cache.get(weight_key)
+                        if cached is not None:
+                            self.finish_record(record, [float(weight) for weight in cached['animal_weights']])
+                            put(decoded, (record, None))
+                            continue
+                        weight_keys[record['image']] = weight_key
+                    put(decoded, (record, self.pipeline.load(path)))
+                except Exception as e:
+                    record['error'] = f"decode: {e}"
+                    put(decoded, (record, None))
+            put(decoded, _END)
+
+        def stage(function, name, input_queue, output_queue):
+            def worker():
+                while True:
+                    item = input_queue.get()
+                    if item is _END or stop.is_set():
+                        put(output_queue, _END)
+                        return
+                    record, data = item
+                    if data is not None:
+                        try:
+                            data = function(data)
+                        except Exception as e:
+                            record['error'] = f"{name}: {e}"
+                            data = None
+                    put(output_queue, (record, data))
+            return worker
+
+        workers = [
+            threading.Thread(target=decode_stage, daemon=True),
+            threading.Thread(target=stage(self.pipeline.segmentation_input, 'undistort', decoded, undistorted), daemon=True),
+            threading.Thread(target=stage(self.pipeline.segment, 'segment', undistorted, segmented), daemon=True),
+        ]
+        for worker in workers:
+            worker.start()
+        try:
+            # Prediction runs on the calling thread, batching whatever segmented frames are ready
+            finished = False
+            while not finished:
+                items = [segmented.get()]
+                while items[-1] is not _END and len(items) < self.batch_size:
+                    try:
+                        items.append(segmented.get_nowait())
+                    except queue.Empty:
+                        break
+                if items[-1] is _END:
+                    items.pop()
+                    finished = True
+                ready = [(record, frame) for record, frame in items if frame is not None]
+                if ready:
+                    try:
+                        # frame is (processed_image, result), see CowPipeline.predict_frames
+                        frame_animals = self.pipeline.predict_frames([frame for _, frame in ready])
+                        for (record, _), animals in zip(ready, frame_animals):
+                            weights = [animal['weight'] for animal in animals]
+                            if not weights:
+                                record['error'] = "predict: no cow detected in the image"
+                                continue
+                            if None in weights:
+                                record['error'] = "predict: no geometric estimate and no fallback"
+                                continue
+                            self.finish_record(record, weights)
+                            if record['image'] in weight_keys:
+                                self.cache.put(weight_keys.pop(record['image']), animal_weights=np.array(weights))
+                    except Exception as e:
+                        for record, _ in ready:
+                            record['error'] = f"predict: {e}"
+                for record, _ in items:
+                    yield record
+        finally:
+            stop.set()
+            for worker in workers:
+                worker.join(timeout=1)
+
+    def new_record(self, path):
+        record = dict.fromkeys(OUTPUT_FIELDS)
+        record['image'] = str(path)
+        try:
+            record['animal_id'], record['actual_weight_kg'], record['sex'] = parse_image_name(path)
+        except (IndexError, ValueError):
+            # Not an id_s_weight_sex name, there is nothing to compare against
+            pass
+        return record
+
+    def finish_record(self, record, animal_weights):
+        # The first animal is the one compared against the weight in the file name, like in the demo
+        record['predicted_weight_kg'] = round(animal_weights[0], 2)
+        record['animal_count'] = len(animal_weights)
+        record['animal_weights_kg'] = [round(weight, 2) for weight in animal_weights]
+        if record['actual_weight_kg'] is not None:
+            record['error_kg'] = round(animal_weights[0] - record['actual_weight_kg'], 2)
+
+
+def write_results(records, output_path):
+    count = 0
+    with open(output_path, 'w', newline='') as output_file:
+        if output_path.endswith('.jsonl'):
+            for record in records:
+                output_file.write(json.dumps(record) + '\n')
+                count += 1
+        else:
+            writer = csv.DictWriter(output_file, fieldnames=OUTPUT_FIELDS)
+            writer.writeheader()
+            for record in records:
+                writer.writerow(record)
+                count += 1
+    return count
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Predict cow weights for a directory or glob of images")
+    parser.add_argument('source', help="Image directory or glob, e.g. 'Images/*.jpg'")
+    parser.add_argument('--output', default='results.csv', help="Output file, .csv or .jsonl")
+    parser.add_argument('--segmentation-weights', default='yolov8m-seg.pt')
+    parser.add_argument('--predictor-weights', default='weights.03.hdf5')
+    parser.add_argument('--predictor-backend', choices=PREDICTOR_BACKENDS, default='keras',
+                        help="Runtime for --predictor-weights, onnx and openvino take an exported model")
+    parser.add_argument('--queue-size', type=int, default=4)
+    parser.add_argument('--batch-size', type=int, default=16, help="Maximum images per predictor forward pass")
+    parser.add_argument('--cache-dir', default='.livelens_cache', help="Artifact cache directory")
+    parser.add_argument('--no-cache', action='store_true', help="Recompute every image")
+    parser.add_argument('--workers', action='store_true',
+                        help="Run segmentation and prediction in separate worker processes")
+    parser.add_argument('--weight-estimator', help="Fitted GeometricWeightEstimator JSON")
+    parser.add_argument('--no-fallback', action='store_true',
+                        help="Weigh from the masks only, without loading the ResNet")
+    args = parser.parse_args()
+    if args.no_fallback and not args.weight_estimator:
+        parser.error("--no-fallback needs --weight-estimator")
+    if args.no_fallback and args.workers:
+        parser.error("--workers runs the ResNet in its own process, it cannot be combined with --no-fallback")
+
+    image_paths = expand_image_paths(args.source)
+    print(f"Found {len(image_paths)} images")
+    thread_budget = load_thread_budget()
+    print(f"Using {thread_budget}")
+    thread_budget.apply_opencv()
+    weight_estimator = GeometricWeightEstimator(args.weight_estimator, fallback=not args.no_fallback) \
+        if args.weight_estimator else None
+    workers = None
+    if args.workers:
+        # Segmentation of the next images overlaps the predictor process working on this batch
+        workers = StageWorkers(partial(SegmentationModel, args.segmentation_weights),
+                               partial(CowWeightPredictor, args.predictor_weights, batch_size=args.batch_size,
+                                       backend=args.predictor_backend, threads=thread_budget.predict_intra),
+                               batch_size=args.batch_size, thread_budget=thread_budget)
+        workers.start()
+        pipeline = CowPipeline(WorkerSegmentationModel(workers), DistortionCorrection((9, 6), (4032, 2268)),
+                               WorkerWeightPredictor(workers), weight_estimator=weight_estimator)
+    else:
+        thread_budget.apply_segmentation()
+        weight_predictor = None
+        if not args.no_fallback:
+            thread_budget.apply_prediction()
+            weight_predictor = CowWeightPredictor(args.predictor_weights, batch_size=args.batch_size,
+                                                  backend=args.predictor_backend, threads=thread_budget.predict_intra)
+        pipeline = CowPipeline(SegmentationModel(args.segmentation_weights),
+                               DistortionCorrection((9, 6), (4032, 2268)), weight_predictor,
+                               weight_estimator=weight_estimator)
+    cache = None if args.no_cache else ArtifactCache(
+        args.cache_dir, stage_dependencies=stage_dependencies(
+            args.segmentation_weights, None if args.no_fallback else args.predictor_weights,
+            weight_estimator=args.weight_estimator))
+    batch = BatchPipeline(pipeline, queue_size=args.queue_size, batch_size=args.batch_size, cache=cache)
+    count = write_results(batch.run(image_paths), args.output)
+    if cache is not None:
+        # Wait for the last cache entries to reach the disk
+        cache.shutdown()
+    if workers is not None:
+        workers.close()
+    print(f"Wrote {count} results to {args.output}")
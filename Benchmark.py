@@ -0,0 +1,277 @@
+import argparse
+import json
+import os
+import platform
+import sys
+import time
+import tracemalloc
+import numpy as np
+import cv2 as cv
+from SegmentationModel import SegmentationModel
+from DistortionCorrection import DistortionCorrection, load_calibration_file
+from FramePreparation import WORKING_SIZE
+from CowWeightPredictor import CowWeightPredictor
+from Tracing import tracer
+
+"""
+Usage:
+    python Benchmark.py --output bench.json
+    python Benchmark.py --models real --repeat 50 --output bench_real.json
+    python Benchmark.py --baseline bench.json --output bench_new.json
+
+Times every pipeline stage and the end-to-end chain on synthetic 1900x1425 and 4032x2268
+frames and reports latency percentiles, throughput and peak memory. With --models stand-in
+(the default when the weight files are missing) YOLO and the Keras model are replaced by small
+deterministic stand-ins, so the numbers for everything around them are comparable on any CPU.
+With --baseline the run is compared against an earlier JSON file and the script exits with
+status 1 if any stage got slower than --tolerance times its baseline median.
+"""
+
+RESOLUTIONS = [(1900, 1425), (4032, 2268)]
+SEGMENTATION_WEIGHTS = 'yolov8m-seg.pt'
+PREDICTOR_WEIGHTS = 'weights.03.hdf5'
+
+
+class StandInTensor:
+    """
+        Just enough of the torch.Tensor / tf.Tensor interface for the code that reads model outputs
+    """
+    def __init__(self, array):
+        self.array = np.asarray(array)
+
+    def __getitem__(self, index):
+        return StandInTensor(self.array[index])
+
+    def __len__(self):
+        return len(self.array)
+
+    def cpu(self):
+        return self
+
+    def numpy(self):
+        return self.array
+
+    def item(self):
+        return self.array.item()
+
+
+class StandInResult:
+    def __init__(self, box, confidence, mask):
+        self.boxes = type('Boxes', (), {})()
+        self.boxes.xyxy = StandInTensor(np.array([box], dtype=np.float32))
+        self.boxes.conf = StandInTensor(np.array([confidence], dtype=np.float32))
+        self.boxes.cls = StandInTensor(np.array([19], dtype=np.float32))
+        self.masks = type('Masks', (), {})()
+        self.masks.data = StandInTensor(mask[None].astype(np.float32))
+
+
+class StandInYOLO:
+    """
+        Deterministic replacement for the YOLO model, segments the largest bright blob
+    """
+    def predict(self, source, conf=0.25, save=False, **kwargs):
+        if isinstance(source, list):
+            # A list of images is one batch, one result per image like YOLO
+            return [self.predict(image)[0] for image in source]
+        gray = cv.cvtColor(source, cv.COLOR_BGR2GRAY)
+        gray = cv.GaussianBlur(gray, (9, 9), 0)
+        _, mask = cv.threshold(gray, 0, 1, cv.THRESH_BINARY + cv.THRESH_OTSU)
+        count, labels, stats, _ = cv.connectedComponentsWithStats(mask)
+        if count > 1:
+            largest = 1 + int(np.argmax(stats[1:, cv.CC_STAT_AREA]))
+            mask = (labels == largest).astype(np.uint8)
+            x, y, w, h = stats[largest, :4]
+        else:
+            x, y, w, h = 0, 0, source.shape[1], source.shape[0]
+        return [StandInResult((x, y, x + w, y + h), 0.9, mask)]
+
+
+class StandInRegressor:
+    """
+        Deterministic replacement for the predictor backend, a fixed random projection
+        of a pooled image, so the cost scales with the batch like the real one would
+    """
+    def __init__(self, seed=0):
+        self.weights = np.random.default_rng(seed).normal(size=(7 * 7 * 3,)).astype(np.float32)
+
+    def __call__(self, batch):
+        batch = np.asarray(batch, dtype=np.float32)
+        pooled = batch.reshape(len(batch), 7, 32, 7, 32, 3).mean(axis=(2, 4)).reshape(len(batch), -1)
+        return (pooled @ self.weights / 255.0 + 300.0)[:, None]
+
+
+def stand_in_segmentation_model():
+    return SegmentationModel(model=StandInYOLO())
+
+
+def stand_in_weight_predictor(batch_size=16):
+    # TensorFlow is never imported, the batching code path stays the real one
+    return CowWeightPredictor(batch_size=batch_size, backend='stand-in', forward=StandInRegressor())
+
+
+def synthetic_frame(width, height, seed=0):
+    # Noisy dark background with a bright cow-sized ellipse, the same for every run
+    rng = np.random.default_rng(seed)
+    frame = rng.integers(0, 60, size=(height, width, 3), dtype=np.uint8)
+    center = (width // 2, height // 2)
+    axes = (width // 4, height // 5)
+    cv.ellipse(frame, center, axes, 0, 0, 360, (200, 190, 180), -1)
+    return frame
+
+
+def load_qimage_converter():
+    try:
+        from main import Backend
+    except Exception as e:
+        print(f"Skipping QImage conversion, PySide6 is not available: {e}")
+        return None
+    return Backend.convert_npy2qimg
+
+
+def summarize(latencies, peak_bytes):
+    latencies = np.asarray(latencies) * 1000.0
+    return {
+        'runs': int(len(latencies)),
+        'mean_ms': float(latencies.mean()),
+        'p50_ms': float(np.percentile(latencies, 50)),
+        'p90_ms': float(np.percentile(latencies, 90)),
+        'p99_ms': float(np.percentile(latencies, 99)),
+        'max_ms': float(latencies.max()),
+        'throughput_per_s': float(1000.0 / latencies.mean()) if latencies.mean() > 0 else None,
+        'peak_memory_mb': peak_bytes / 1024**2,
+    }
+
+
+"""
+    time_stage runs function repeat times after warmup calls and returns its statistics.
+    The tracer is paused for all of it, so the latencies leave out its per stage overhead
+    (timers, RSS reads and array descriptions). Peak memory comes from one more call under
+    tracemalloc, as the peak above the memory in use before that call
+"""
+def time_stage(function, repeat, warmup=2):
+    with tracer.paused():
+        for _ in range(warmup):
+            function()
+        latencies = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            function()
+            latencies.append(time.perf_counter() - start)
+        tracemalloc.start()
+        baseline, _ = tracemalloc.get_traced_memory()
+        tracemalloc.reset_peak()
+        function()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    return summarize(latencies, max(peak - baseline, 0))
+
+
+def benchmark_resolution(width, height, segmentation_model, weight_predictor, to_qimage, repeat):
+    distortion_correction = DistortionCorrection((9, 6), (4032, 2268))
+    distortion_correction.mtx = load_calibration_file('mtx_05zoom')
+    distortion_correction.dist = load_calibration_file('dist_05zoom')
+    frame = synthetic_frame(width, height)
+    corrected_image, _ = distortion_correction.distortion_correction(frame)
+    segmentation_input = distortion_correction.undistort_resized(frame, (640, 480), calibration_size=WORKING_SIZE)
+    processed_image = segmentation_model.preprocess_image(segmentation_input)
+    results = segmentation_model.segment(processed_image)
+
+    def end_to_end():
+        image = distortion_correction.undistort_resized(frame, (640, 480), calibration_size=WORKING_SIZE)
+        image = segmentation_model.preprocess_image(image)
+        segmentation_model.get_detection(segmentation_model.segment(image))
+        weight_predictor.make_prediction(image)
+
+    stages = {
+        'distortion_correction': lambda: distortion_correction.distortion_correction(frame),
+        'undistort_resized': lambda: distortion_correction.undistort_resized(frame, (640, 480), calibration_size=WORKING_SIZE),
+        'preprocess_image': lambda: segmentation_model.preprocess_image(corrected_image),
+        'segment': lambda: segmentation_model.segment(processed_image),
+        'get_filtered': lambda: segmentation_model.get_filtered(processed_image, results),
+        'get_bounding': lambda: segmentation_model.get_bounding(processed_image, results),
+        'make_prediction': lambda: weight_predictor.make_prediction(processed_image),
+        'end_to_end': end_to_end,
+    }
+    if to_qimage is not None:
+        stages['convert_npy2qimg'] = lambda: to_qimage(corrected_image)
+    report = {}
+    for name, function in stages.items():
+        report[name] = time_stage(function, repeat)
+        print(f"{width}x{height} {name:24s} p50 {report[name]['p50_ms']:9.2f} ms  "
+              f"p99 {report[name]['p99_ms']:9.2f} ms  peak {report[name]['peak_memory_mb']:8.1f} MB")
+    return report
+
+
+def compare(report, baseline, tolerance):
+    regressions = []
+    for resolution, stages in report['results'].items():
+        for stage, stats in stages.items():
+            previous = baseline.get('results', {}).get(resolution, {}).get(stage)
+            if previous is None or previous['p50_ms'] <= 0:
+                continue
+            ratio = stats['p50_ms'] / previous['p50_ms']
+            print(f"{resolution} {stage:24s} {previous['p50_ms']:9.2f} -> {stats['p50_ms']:9.2f} ms  x{ratio:.2f}")
+            if ratio > tolerance:
+                regressions.append(f"{resolution} {stage}")
+    return regressions
+
+
+def peak_rss_mb():
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+    return peak / 1024**2 if sys.platform == 'darwin' else peak / 1024
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark every LiveLens pipeline stage")
+    parser.add_argument('--models', choices=['auto', 'stand-in', 'real'], default='auto')
+    parser.add_argument('--repeat', type=int, default=20)
+    parser.add_argument('--output', default='bench.json')
+    parser.add_argument('--baseline', help="Earlier benchmark JSON to compare against")
+    parser.add_argument('--tolerance', type=float, default=1.2, help="Allowed p50 slowdown vs the baseline")
+    args = parser.parse_args()
+
+    use_real = args.models == 'real' or (args.models == 'auto' and os.path.exists(SEGMENTATION_WEIGHTS)
+                                         and os.path.exists(PREDICTOR_WEIGHTS))
+    if use_real:
+        segmentation_model = SegmentationModel(SEGMENTATION_WEIGHTS)
+        weight_predictor = CowWeightPredictor(PREDICTOR_WEIGHTS)
+    else:
+        segmentation_model = stand_in_segmentation_model()
+        weight_predictor = stand_in_weight_predictor()
+    to_qimage = load_qimage_converter()
+
+    report = {
+        'meta': {
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'models': 'real' if use_real else 'stand-in',
+            'repeat': args.repeat,
+            'platform': platform.platform(),
+            'processor': platform.processor(),
+            'cpu_count': os.cpu_count(),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'opencv': cv.__version__,
+        },
+        'results': {},
+    }
+    for width, height in RESOLUTIONS:
+        report['results'][f"{width}x{height}"] = benchmark_resolution(
+            width, height, segmentation_model, weight_predictor, to_qimage, args.repeat)
+    report['meta']['peak_rss_mb'] = peak_rss_mb()
+
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"Wrote {args.output}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(report, baseline, args.tolerance)
+        if regressions:
+            print("Regressions: " + ", ".join(regressions))
+            sys.exit(1)
@@ -0,0 +1,162 @@
+import threading
+from pathlib import Path
+from DistortionCorrection import load_calibration_file
+from FramePreparation import MODEL_INPUT_SIZE, WORKING_SIZE, decode, fit
+from Tracing import tracer
+
+"""
+Usage:
+    pipeline = CowPipeline(SegmentationModel("yolov8m-seg.pt"),
+                           DistortionCorrection((9, 6), (4032, 2268)),
+                           CowWeightPredictor("weights.03.hdf5"))
+    image = pipeline.load('Images/459_s_199_F.jpg')  # BGR, like every image below
+    corrected_img, cropped_img = pipeline.undistort(image)
+    segmentation_input = pipeline.segmentation_input(image)
+    processed_image, results = pipeline.segment(segmentation_input)
+    weight_kg = pipeline.predict(processed_image)
+
+    # With a GeometricWeightEstimator most animals are weighed from their mask, see predict_animals
+    pipeline = CowPipeline(segmentation_model, distortion_correction, weight_predictor,
+                           weight_estimator=GeometricWeightEstimator('geometric_weights.json'))
+"""
+
+# Share of the frame an animal's box must cover to be weighed from the whole frame, see predict_animals
+WHOLE_FRAME_COVERAGE = 0.3
+
+"""
+    parse_image_name splits an image file name of the form id_s_weight_sex.jpg (e.g. 10_s_87_F.jpg)
+    Outputs:
+    - animal_id, weight in kg, sex
+"""
+def parse_image_name(image_path):
+    parts = Path(image_path).stem.split('_')
+    animal_id = parts[0]
+    weight = float(parts[2])
+    sex = parts[3] if len(parts) > 3 else None
+    return animal_id, weight, sex
+
+
+class CowPipeline:
+    """
+        Runs the model chain used by Backend without any Qt dependency, one stage per method
+        so callers can schedule the stages however they like
+    """
+    def __init__(self, segmentation_model, distortion_correction, weight_predictor,
+                 mtx_path='mtx_05zoom', dist_path='dist_05zoom', weight_estimator=None):
+        self.SegmentationModel = segmentation_model
+        self.DistortionCorrection = distortion_correction
+        self.CowWeightPredictor = weight_predictor
+        self.WeightEstimator = weight_estimator
+        self.mtx_path = mtx_path
+        self.dist_path = dist_path
+        # The models are not safe to call from several threads at once, one lock each so the
+        # Backend's pipeline and the video stream take turns while segment and predict still overlap
+        self.segmentation_lock = threading.Lock()
+        self.predictor_lock = threading.Lock()
+
+    def prepare_calibration(self):
+        self.DistortionCorrection.mtx = load_calibration_file(self.mtx_path)
+        self.DistortionCorrection.dist = load_calibration_file(self.dist_path)
+
+    def load(self, image_path):
+        # The BGR working frame, large JPEGs are decoded at reduced scale
+        with tracer.stage('decode') as span:
+            image = decode(image_path, WORKING_SIZE)
+            span.add(image=image)
+        with tracer.stage('resize', image=image):
+            return fit(image, WORKING_SIZE)
+
+    def undistort(self, image):
+        with tracer.stage('undistort', image=image):
+            self.prepare_calibration()
+            return self.DistortionCorrection.distortion_correction(image)
+
+    def segmentation_input(self, image):
+        # Undistort and downscale in one remap pass; the full size views are not needed
+        with tracer.stage('undistort_resized', image=image):
+            self.prepare_calibration()
+            return self.DistortionCorrection.undistort_resized(image, MODEL_INPUT_SIZE)
+
+    """
+        frame_input undistorts a BGR video frame straight to the 640x480 model input, the same
+        image segment returns as processed_image. Frames of any size are mapped as if they had
+        been resized to WORKING_SIZE first, like load does for still images
+    """
+    def frame_input(self, frame):
+        with tracer.stage('undistort_resized', image=frame):
+            self.prepare_calibration()
+            return self.DistortionCorrection.undistort_resized(frame, MODEL_INPUT_SIZE, calibration_size=WORKING_SIZE)
+
+    def segment(self, segmentation_input):
+        with tracer.stage('segment', image=segmentation_input):
+            processed_image = self.SegmentationModel.preprocess_image(segmentation_input)
+            with self.segmentation_lock:
+                results = self.SegmentationModel.segment(processed_image)
+            return processed_image, results
+
+    def predict(self, processed_image):
+        with tracer.stage('predict', image=processed_image):
+            with self.predictor_lock:
+                prediction = self.CowWeightPredictor.make_prediction(processed_image)
+            return float(prediction[0][0])
+
+    def predict_batch(self, processed_images):
+        with tracer.stage('predict', batch=[image.shape for image in processed_images]):
+            with self.predictor_lock:
+                weights = self.CowWeightPredictor.predict_batch(processed_images)
+            return [float(weight) for weight in weights]
+
+    def estimate_weight(self, result, index):
+        # The geometric weight of one animal, None without an estimator or when it is not trusted
+        if self.WeightEstimator is None or index >= len(result):
+            return None
+        with tracer.stage('geometric_estimate'):
+            estimate = self.WeightEstimator.estimate(result, index)
+        return estimate['weight'] if self.WeightEstimator.accepts(estimate) else None
+
+    """
+        predict_animals weighs every detected animal, from its mask where the geometric estimate
+        is trusted and with one batched forward pass for the rest.
+        The input is chosen per animal, never by how many are in the frame: an animal whose box
+        covers WHOLE_FRAME_COVERAGE of the frame keeps the whole frame, the framing the model was
+        trained on, smaller ones get their own masked crop
+        Outputs:
+        - one dict per animal with box, confidence and weight in kg, in detection order
+    """
+    def predict_animals(self, processed_image, result):
+        return self.predict_frames([(processed_image, result)])[0]
+
+    """
+        predict_frames runs predict_animals on several (processed_image, result) frames, with
+        one forward pass for the animals of all frames together
+        Outputs:
+        - one list of animal dicts per frame, empty when nothing was detected. Without a weight
+          predictor (an estimator without fallback) untrusted animals keep weight None
+    """
+    def predict_frames(self, frames):
+        frame_weights = []
+        images = []
+        pending = [] # (frame, animal) of every image
+        for f, (processed_image, result) in enumerate(frames):
+            weights = [self.estimate_weight(result, i) for i in range(len(result))]
+            missing = [i for i, weight in enumerate(weights) if weight is None]
+            if missing and self.CowWeightPredictor is not None:
+                crops = None
+                frame_area = result.image_shape[0] * result.image_shape[1]
+                for i in missing:
+                    x1, y1, x2, y2 = result.mask_boxes[i]
+                    if (x2 - x1) * (y2 - y1) >= WHOLE_FRAME_COVERAGE * frame_area:
+                        images.append(processed_image)
+                    else:
+                        crops = crops or result.instance_crops(processed_image)
+                        images.append(crops[i])
+                pending.extend((f, i) for i in missing)
+            frame_weights.append(weights)
+        if images:
+            for (f, i), weight in zip(pending, self.predict_batch(images)):
+                frame_weights[f][i] = weight
+        return [[{'box': [float(v) for v in result.boxes[i]],
+                  'confidence': float(result.confidences[i]),
+                  'weight': weights[i]} for i in range(len(result))]
+                for (_, result), weights in zip(frames, frame_weights)]
+
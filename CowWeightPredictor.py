@@ -1,14 +1,17 @@
-import tensorflow as tf
+import os
+import threading
 import cv2
 import numpy as np
+from InferenceBackends import KerasBackend, load_predictor_backend
+# TensorFlow is imported lazily so importing this module stays cheap
 
 """
 Usage:
     weights_path = '/path/to/your/weights.03.hdf5'
     image_path = '/path/to/your/test/image.jpg'
 
-    # Instantiate the model
-    prediction_model = CowWeightPredictor(weights_path)
+    # Instantiate the model, optionally caching the assembled model for faster reloads
+    prediction_model = CowWeightPredictor(weights_path, model_cache_path='weights.03.keras')
 
     # Load and preprocess the image
     img = cv2.imread(image_path)
@@ -17,22 +20,73 @@ Usage:
     # Make a prediction
     prediction = prediction_model.make_prediction(img)
     print(prediction)
+
+    # Or predict many animals at once, returns one weight per image
+    predictions = prediction_model.predict_batch([img, img, img])
+
+    # Or run an exported model without loading TensorFlow at all, see InferenceBackends.py
+    prediction_model = CowWeightPredictor('weights.03.int8.onnx', backend='onnx')
+
+    # Or wrap a forward pass that runs elsewhere (a worker process, the inference server)
+    prediction_model = CowWeightPredictor(forward=forward, backend='remote')
     
 """
 class CowWeightPredictor:
-    def __init__(self, weights_path):
+    def __init__(self, weights_path=None, batch_size=16, model_cache_path=None, backend='keras', threads=None,
+                 forward=None):
         self.image_size = (224, 224)
-        self.model = self.init_model(weights_path)
+        self.batch_size = batch_size
+        self.backend = backend
+        if forward is not None:
+            # A ready forward pass taking a uint8 NHWC batch, nothing to load or warm up here
+            self.model = None
+            self.forward = forward
+        elif backend == 'keras':
+            self.model = self.load_model(weights_path, model_cache_path)
+            self.forward = KerasBackend(self.model, self.image_size)
+        else:
+            # weights_path is an exported model, e.g. weights.03.onnx, TensorFlow is never imported
+            self.model = None
+            self.forward = load_predictor_backend(backend, weights_path, threads)
+        # Preallocated uint8 input batch, reused by every call under batch_lock
+        self.batch_buffer = np.empty((batch_size, self.image_size[1], self.image_size[0], 3), dtype=np.uint8)
+        self.batch_lock = threading.Lock()
+        if forward is None:
+            self.warm_up()
     
+    """
+        load_model reuses the serialized model at model_cache_path while it is newer than the
+        weights file, otherwise it builds the model and writes the cache for the next start
+    """
+    def load_model(self, weights_path, model_cache_path=None):
+        import tensorflow as tf
+        if model_cache_path and os.path.exists(model_cache_path) \
+                and os.path.getmtime(model_cache_path) >= os.path.getmtime(weights_path):
+            try:
+                return tf.keras.models.load_model(model_cache_path, compile=False)
+            except Exception as e:
+                print(f"Failed to load cached model {model_cache_path}, rebuilding: {e}")
+        model = self.init_model(weights_path)
+        if model_cache_path:
+            self.save_model(model, model_cache_path)
+        return model
+
+    def save_model(self, model, model_cache_path):
+        try:
+            model.save(model_cache_path)
+        except Exception as e:
+            print(f"Failed to cache model to {model_cache_path}: {e}")
+
     def init_model(self, weights_path):
+        import tensorflow as tf
         # upsample input
         inputs = tf.keras.layers.Input(shape=(self.image_size[0], self.image_size[1], 3))
         
-        # feature extraction using imagenet weights
+        # feature extraction, no imagenet weights since load_weights overwrites them anyway
         resnet_feature_extractor = tf.keras.applications.resnet.ResNet50(
             input_shape=(self.image_size[0], self.image_size[1], 3),
             include_top=False,
-            weights='imagenet')(inputs)
+            weights=None)(inputs)
 
         # some other layers
         temp = tf.keras.layers.GlobalAveragePooling2D()(resnet_feature_extractor)
@@ -43,11 +97,31 @@ class CowWeightPredictor:
         model.load_weights(weights_path)
         return model
     
+    def warm_up(self):
+        # Trace the forward pass once at load time so the first real batch is not slow
+        self.forward(np.zeros_like(self.batch_buffer[:1]))
+
     def make_prediction(self, image):
-        image_copy = np.copy(image)
-        image_copy = cv2.resize(image_copy, self.image_size)
-        image_copy = np.expand_dims(image_copy, axis=0) # add batch dimension
-        return self.model.predict(image_copy)
-    
-        
-        
\ No newline at end of file
+        # Same (1, 1) output as model.predict on a single image
+        return self.predict_batch([image]).reshape(1, 1)
+
+    """
+        predict_batch takes a list or stacked array of images and returns one weight per image
+        Images are resized into the preallocated batch buffer and run batch_size at a time,
+        any dtype is cast to the uint8 the model was trained on
+    """
+    def predict_batch(self, images, batch_size=None):
+        batch_size = min(batch_size or self.batch_size, self.batch_buffer.shape[0])
+        predictions = np.empty(len(images), dtype=np.float32)
+        with self.batch_lock:
+            for start in range(0, len(images), batch_size):
+                chunk = images[start:start + batch_size]
+                batch = self.batch_buffer[:len(chunk)]
+                for i, image in enumerate(chunk):
+                    if image.shape[:2] == batch.shape[1:3]:
+                        batch[i] = image
+                    else:
+                        # cv2 only resizes into dst when the dtype matches, so assign the result
+                        batch[i] = cv2.resize(image, self.image_size)
+                predictions[start:start + len(chunk)] = np.asarray(self.forward(batch)).reshape(len(chunk), -1)[:, 0]
+        return predictions
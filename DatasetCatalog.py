@@ -0,0 +1,333 @@
+import argparse
+import glob
+import hashlib
+import os
+import sqlite3
+import time
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+import numpy as np
+import cv2 as cv
+from ArtifactCache import hash_file
+from FramePreparation import MODEL_INPUT_SIZE, image_size
+
+"""
+Usage:
+    # Index an image tree, decoding only files that are new or changed since the last run
+    python DatasetCatalog.py refresh Images
+    python DatasetCatalog.py evaluate --predictor-weights weights.03.hdf5
+
+    catalog = DatasetCatalog('.livelens_catalog')
+    catalog.refresh('Images')
+    records = catalog.records("weight_kg IS NOT NULL AND sex = ?", ('F',))
+    slots = [record['slot'] for record in records]
+    segmentation_inputs = catalog.segmentation_inputs()[slots]   # (N, 480, 640, 3) BGR, undistorted
+    predictor_inputs = catalog.predictor_inputs()[slots]         # (N, 224, 224, 3) BGR
+    weights = CowWeightPredictor('weights.03.hdf5').predict_batch(predictor_inputs)
+
+The catalog is a SQLite table with one row per image (id, weight and sex parsed from
+id_s_weight_sex.jpg, path, content hash, original size) and two memory mapped uint8 arrays
+holding exactly what the pipeline feeds the models: the undistorted 640x480 segmentation input
+and its 224x224 resize for CowWeightPredictor. Each row owns a slot in the arrays, so evaluation
+and fine-tuning runs read slices without decoding a single JPEG.
+
+A refresh only decodes files whose size or modification time changed and whose content hash
+differs; a touched or moved file just has its row updated. Rows of deleted files are dropped
+and their slots reused. Editing mtx_05zoom or dist_05zoom marks every row stale, so the arrays
+are rebuilt on the next refresh. Rows are committed only after their slots are flushed, so an
+interrupted refresh keeps everything it finished.
+"""
+
+# Bump when the preprocessing changes, every row is then rebuilt on the next refresh
+CATALOG_FORMAT_VERSION = '1'
+PREDICTOR_INPUT_SIZE = (224, 224)
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS images (
+    slot INTEGER PRIMARY KEY,
+    path TEXT UNIQUE NOT NULL,
+    animal_id TEXT,
+    weight_kg REAL,
+    sex TEXT,
+    file_hash TEXT NOT NULL,
+    width INTEGER,
+    height INTEGER,
+    mtime_ns INTEGER,
+    size INTEGER,
+    prepared TEXT
+);
+CREATE INDEX IF NOT EXISTS images_hash ON images (file_hash);
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+"""
+
+# Each preparation process keeps its own pipeline, so the undistortion maps are built once per process
+_pipeline = None
+
+
+def find_images(source):
+    # A directory is searched recursively, anything else is a glob
+    if os.path.isdir(source):
+        paths = []
+        for root, _, names in os.walk(source):
+            paths.extend(os.path.join(root, name) for name in names if name.lower().endswith(IMAGE_EXTENSIONS))
+    else:
+        paths = glob.glob(source, recursive=True)
+    return sorted(os.path.normpath(path) for path in paths)
+
+
+def image_labels(path):
+    # animal_id, weight in kg and sex from an id_s_weight_sex name, all None for other names
+    from CowPipeline import parse_image_name
+    try:
+        return parse_image_name(path)
+    except (IndexError, ValueError):
+        return None, None, None
+
+
+def _init_prepare_worker():
+    # One process per core already, OpenCV threads inside each would only compete
+    cv.setNumThreads(1)
+
+
+"""
+    prepare_image runs in the catalog worker processes: decode, undistort to the segmentation
+    input and resize that to the predictor input, exactly as the pipeline does
+    Outputs:
+    - path, original (width, height), segmentation input, predictor input; None arrays on failure
+"""
+def prepare_image(path, mtx_path, dist_path):
+    global _pipeline
+    if _pipeline is None or (_pipeline.mtx_path, _pipeline.dist_path) != (mtx_path, dist_path):
+        from DistortionCorrection import DistortionCorrection
+        from CowPipeline import CowPipeline
+        _pipeline = CowPipeline(None, DistortionCorrection((9, 6), (4032, 2268)), None, mtx_path, dist_path)
+    try:
+        segmentation_input = _pipeline.segmentation_input(_pipeline.load(path))
+    except (IOError, cv.error) as e:
+        print(f"Skipping {path}: {e}")
+        return path, None, None, None
+    # Same resize CowWeightPredictor.predict_batch applies to the 640x480 processed image
+    predictor_input = cv.resize(segmentation_input, PREDICTOR_INPUT_SIZE)
+    return path, image_size(path), segmentation_input, predictor_input
+
+
+class DatasetCatalog:
+    def __init__(self, catalog_dir='.livelens_catalog', mtx_path='mtx_05zoom', dist_path='dist_05zoom'):
+        self.catalog_dir = catalog_dir
+        self.mtx_path = mtx_path
+        self.dist_path = dist_path
+        os.makedirs(catalog_dir, exist_ok=True)
+        self.db = sqlite3.connect(os.path.join(catalog_dir, 'catalog.sqlite'))
+        self.db.row_factory = sqlite3.Row
+        self.db.executescript(SCHEMA)
+        # Slot shapes of the two arrays, the first dimension is the capacity
+        self.shapes = {
+            'segmentation_inputs': (MODEL_INPUT_SIZE[1], MODEL_INPUT_SIZE[0], 3),
+            'predictor_inputs': (PREDICTOR_INPUT_SIZE[1], PREDICTOR_INPUT_SIZE[0], 3),
+        }
+        self.capacity = int(self.get_meta('capacity', 0))
+
+    def get_meta(self, key, default=None):
+        row = self.db.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return default if row is None else row['value']
+
+    def set_meta(self, key, value):
+        self.db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, str(value)))
+
+    def array_path(self, name):
+        return os.path.join(self.catalog_dir, name + '.u8')
+
+    def open_array(self, name, mode='r'):
+        if self.capacity == 0:
+            # np.memmap cannot map an empty file, an empty catalog has no slots to read
+            return np.empty((0, *self.shapes[name]), dtype=np.uint8)
+        return np.memmap(self.array_path(name), dtype=np.uint8, mode=mode, shape=(self.capacity, *self.shapes[name]))
+
+    def segmentation_inputs(self):
+        # Read-only view of every slot, index it with the slot of each record
+        return self.open_array('segmentation_inputs')
+
+    def predictor_inputs(self):
+        return self.open_array('predictor_inputs')
+
+    def ensure_capacity(self, slots):
+        # Grows both files by doubling, new slots read as zeros until written
+        if slots <= self.capacity:
+            return
+        capacity = max(slots, 2 * self.capacity, 64)
+        for name, shape in self.shapes.items():
+            with open(self.array_path(name), 'ab') as f:
+                f.truncate(capacity * int(np.prod(shape)))
+        self.capacity = capacity
+        self.set_meta('capacity', capacity)
+
+    def pipeline_fingerprint(self):
+        # What the stored arrays depend on besides the image itself
+        digest = hashlib.sha256(f"{CATALOG_FORMAT_VERSION}:{MODEL_INPUT_SIZE}:{PREDICTOR_INPUT_SIZE}".encode())
+        for path in (self.mtx_path, self.dist_path):
+            digest.update(hash_file(path).encode())
+        return digest.hexdigest()
+
+    def records(self, where=None, params=()):
+        query = "SELECT * FROM images" + (f" WHERE {where}" if where else "") + " ORDER BY path"
+        return [dict(row) for row in self.db.execute(query, params)]
+
+    def __len__(self):
+        return self.db.execute("SELECT COUNT(*) FROM images").fetchone()[0]
+
+    """
+        refresh brings the catalog up to date with the images under source, see the module
+        docstring. Rows of files outside source are kept unless the file no longer exists
+        Outputs:
+        - counts of added, updated, moved, unchanged, removed and failed images
+    """
+    def refresh(self, source, workers=None, commit_every=64):
+        fingerprint = self.pipeline_fingerprint()
+        stats = dict.fromkeys(('added', 'updated', 'moved', 'unchanged', 'removed', 'failed'), 0)
+        rows = {row['path']: row for row in self.records()}
+        # Files that disappeared, their rows are reused by a moved copy or dropped at the end
+        missing = {path: row for path, row in rows.items() if not os.path.exists(path)}
+        # Copies of one file share a hash, each moved copy takes one of their rows
+        missing_by_hash = {}
+        for row in missing.values():
+            missing_by_hash.setdefault(row['file_hash'], []).append(row)
+
+        pending = {} # Path to (stat, file hash, slot or None) of the files to decode
+        for path in find_images(source):
+            stat = os.stat(path)
+            row = rows.get(path)
+            if row is not None and (row['mtime_ns'], row['size']) == (stat.st_mtime_ns, stat.st_size) \
+                    and row['prepared'] == fingerprint:
+                stats['unchanged'] += 1
+                continue
+            file_hash = hash_file(path)
+            if row is not None and row['file_hash'] == file_hash and row['prepared'] == fingerprint:
+                # Touched but identical, nothing to decode
+                self.db.execute("UPDATE images SET mtime_ns = ?, size = ? WHERE slot = ?",
+                                (stat.st_mtime_ns, stat.st_size, row['slot']))
+                stats['unchanged'] += 1
+                continue
+            candidates = missing_by_hash.get(file_hash) if row is None else None
+            moved = None
+            if candidates:
+                # Prefer the copy with the same file name, its label matches
+                same_name = [c for c in candidates if os.path.basename(c['path']) == os.path.basename(path)]
+                moved = (same_name or candidates)[0]
+                candidates.remove(moved)
+            if moved is not None and moved['prepared'] == fingerprint:
+                # A rename can correct the label, so it is parsed from the new name
+                self.db.execute("UPDATE images SET path = ?, animal_id = ?, weight_kg = ?, sex = ?, "
+                                "mtime_ns = ?, size = ? WHERE slot = ?",
+                                (path, *image_labels(path), stat.st_mtime_ns, stat.st_size, moved['slot']))
+                del missing[moved['path']]
+                stats['moved'] += 1
+                continue
+            pending[path] = (stat, file_hash, None if row is None else row['slot'])
+
+        for path, row in missing.items():
+            self.db.execute("DELETE FROM images WHERE slot = ?", (row['slot'],))
+            stats['removed'] += 1
+        self.db.commit()
+
+        # New files take the lowest free slots first
+        used = {row[0] for row in self.db.execute("SELECT slot FROM images")}
+        free = iter(sorted(set(range(max(used, default=-1) + 1)) - used))
+        next_slot = max(used, default=-1) + 1
+        slots = {}
+        for path, (_, _, slot) in pending.items():
+            if slot is None:
+                slot = next(free, None)
+                if slot is None:
+                    slot, next_slot = next_slot, next_slot + 1
+            slots[path] = slot
+        self.ensure_capacity(max(slots.values(), default=-1) + 1)
+        self.db.commit()
+        if not pending:
+            return stats
+
+        arrays = {name: self.open_array(name, 'r+') for name in self.shapes}
+        written = []
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_prepare_worker) as pool:
+            for path, size, segmentation_input, predictor_input in pool.map(
+                    prepare_image, list(pending), repeat(self.mtx_path), repeat(self.dist_path)):
+                if segmentation_input is None:
+                    stats['failed'] += 1
+                    continue
+                stat, file_hash, old_slot = pending[path]
+                slot = slots[path]
+                arrays['segmentation_inputs'][slot] = segmentation_input
+                arrays['predictor_inputs'][slot] = predictor_input
+                animal_id, weight_kg, sex = image_labels(path)
+                width, height = size if size is not None else segmentation_input.shape[1::-1]
+                written.append((slot, path, animal_id, weight_kg, sex, file_hash, width, height,
+                                stat.st_mtime_ns, stat.st_size, fingerprint))
+                stats['updated' if old_slot is not None else 'added'] += 1
+                if len(written) >= commit_every:
+                    self.commit_rows(arrays, written)
+                    written = []
+        self.commit_rows(arrays, written)
+        return stats
+
+    def commit_rows(self, arrays, rows):
+        # The slots reach the disk before the rows that point at them
+        for array in arrays.values():
+            array.flush()
+        self.db.executemany("INSERT OR REPLACE INTO images VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+        self.db.commit()
+
+    def close(self):
+        self.db.close()
+
+
+"""
+    evaluate runs the weight predictor over the cataloged predictor inputs of every labeled
+    image, batch_size slots at a time straight from the memory map
+"""
+def evaluate(catalog, weight_predictor, batch_size=64):
+    records = catalog.records("weight_kg IS NOT NULL")
+    if not records:
+        raise ValueError("No labeled images in the catalog")
+    predictor_inputs = catalog.predictor_inputs()
+    slots = np.array([record['slot'] for record in records])
+    actual = np.array([record['weight_kg'] for record in records])
+    predicted = np.empty(len(records), dtype=np.float64)
+    start = time.perf_counter()
+    for offset in range(0, len(slots), batch_size):
+        predicted[offset:offset + batch_size] = weight_predictor.predict_batch(
+            predictor_inputs[slots[offset:offset + batch_size]])
+    elapsed = time.perf_counter() - start
+    errors = predicted - actual
+    return {'images': len(records), 'mae_kg': float(np.abs(errors).mean()), 'bias_kg': float(errors.mean()),
+            'rmse_kg': float(np.sqrt((errors ** 2).mean())), 'images_per_s': len(records) / max(elapsed, 1e-9)}
+
+
+if __name__ == "__main__":
+    from InferenceBackends import PREDICTOR_BACKENDS
+
+    parser = argparse.ArgumentParser(description="Index labeled images with their preprocessed model inputs")
+    parser.add_argument('--catalog-dir', default='.livelens_catalog')
+    commands = parser.add_subparsers(dest='command', required=True)
+    refresh = commands.add_parser('refresh')
+    refresh.add_argument('source', nargs='?', default='Images', help="Image directory (recursive) or glob")
+    refresh.add_argument('--workers', type=int, default=None, help="Decoding processes")
+    evaluate_command = commands.add_parser('evaluate')
+    evaluate_command.add_argument('--predictor-weights', default='weights.03.hdf5')
+    evaluate_command.add_argument('--predictor-backend', choices=PREDICTOR_BACKENDS, default='keras')
+    evaluate_command.add_argument('--batch-size', type=int, default=64)
+    args = parser.parse_args()
+
+    catalog = DatasetCatalog(args.catalog_dir)
+    if args.command == 'refresh':
+        start = time.perf_counter()
+        stats = catalog.refresh(args.source, args.workers)
+        print(", ".join(f"{count} {name}" for name, count in stats.items()) +
+              f" in {time.perf_counter() - start:.1f}s, {len(catalog)} images cataloged")
+    else:
+        from CowWeightPredictor import CowWeightPredictor
+        predictor = CowWeightPredictor(args.predictor_weights, batch_size=args.batch_size,
+                                       backend=args.predictor_backend)
+        report = evaluate(catalog, predictor, args.batch_size)
+        print(f"{report['images']} images: MAE {report['mae_kg']:.1f} kg, bias {report['bias_kg']:+.1f} kg, "
+              f"RMSE {report['rmse_kg']:.1f} kg, {report['images_per_s']:.0f} images/s")
+    catalog.close()
@@ -1,8 +1,96 @@
+import argparse
+import hashlib
+import os
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
 import numpy as np
 import cv2 as cv
 from numpy import asarray
 from PIL import Image
 import glob 
+from ArtifactCache import hash_file
+
+# Loaded calibration files, keyed by path and (mtime, size) so an edited file is reloaded
+_calibration_file_cache = {}
+
+"""
+    load_calibration_file reads a calibration matrix written with np.savetxt, reusing the
+    previously parsed array while the file on disk is unchanged
+"""
+def load_calibration_file(path):
+    stat = os.stat(path)
+    signature = (stat.st_mtime_ns, stat.st_size)
+    cached = _calibration_file_cache.get(path)
+    if cached is not None and cached[0] == signature:
+        return cached[1]
+    values = np.loadtxt(path, delimiter=',', dtype=np.float64)
+    _calibration_file_cache[path] = (signature, values)
+    return values
+
+# Bump when find_corners changes, older cached corners then simply miss
+CORNER_FORMAT_VERSION = '1'
+CORNER_CRITERIA = (cv.TERM_CRITERIA_EPS + cv.TERM_CRITERIA_MAX_ITER, 30, 0.001)
+
+"""
+    find_corners detects the chessboard on a copy downscaled to detect_width and refines the
+    corners with cornerSubPix on the full resolution image
+    Outputs:
+    - (N, 1, 2) float32 corners in full resolution pixels, None when no chessboard is found
+"""
+def find_corners(gray, chessboard_edges, detect_width=1008):
+    h, w = gray.shape[:2]
+    scale = min(1.0, detect_width / w)
+    small = cv.resize(gray, (int(round(w * scale)), int(round(h * scale))), interpolation=cv.INTER_AREA) \
+        if scale < 1.0 else gray
+    flags = cv.CALIB_CB_ADAPTIVE_THRESH + cv.CALIB_CB_NORMALIZE_IMAGE + cv.CALIB_CB_FAST_CHECK
+    ret, corners = cv.findChessboardCorners(small, chessboard_edges, flags=flags)
+    if not ret and scale < 1.0:
+        # Small or distant boards can vanish in the downscaled copy
+        ret, corners = cv.findChessboardCorners(gray, chessboard_edges, flags=flags)
+        scale = 1.0
+    if not ret:
+        return None
+    # Back to full resolution, keeping pixel centres aligned
+    corners = (corners + 0.5) / scale - 0.5
+    return cv.cornerSubPix(gray, corners.astype(np.float32), (11, 11), (-1, -1), CORNER_CRITERIA)
+
+"""
+    detect_file_corners runs in the calibration worker processes. It decodes one image as
+    grayscale, reusing the corners cached under cache_dir for the same file contents
+    Outputs:
+    - path, (width, height) of the image, corners or None
+"""
+def detect_file_corners(path, chessboard_edges, cache_dir=None, detect_width=1008):
+    cache_path = None
+    if cache_dir is not None:
+        key = hashlib.sha256(f"{hash_file(path)}:{chessboard_edges}:{detect_width}:{CORNER_FORMAT_VERSION}"
+                             .encode()).hexdigest()
+        cache_path = os.path.join(cache_dir, key + '.npz')
+        try:
+            with np.load(cache_path) as entry:
+                corners = entry['corners']
+                return path, tuple(int(v) for v in entry['image_size']), corners if len(corners) else None
+        except (OSError, ValueError, KeyError):
+            pass
+    gray = cv.imread(path, cv.IMREAD_GRAYSCALE)
+    if gray is None:
+        return path, None, None
+    image_size = (gray.shape[1], gray.shape[0])
+    corners = find_corners(gray, chessboard_edges, detect_width)
+    if cache_path is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        temp_path = f"{cache_path}.{os.getpid()}.tmp"
+        with open(temp_path, 'wb') as f:
+            np.savez(f, corners=corners if corners is not None else np.zeros((0, 1, 2), np.float32),
+                     image_size=np.array(image_size))
+        os.replace(temp_path, cache_path)
+    return path, image_size, corners
+
+
+def _init_calibration_worker():
+    # One process per core already, OpenCV threads inside each would only compete
+    cv.setNumThreads(1)
+
 
 """
 # Usage
@@ -13,8 +101,8 @@ if __name__ == "__main__":
     image_paths = glob.glob(f'{image_dir}/*.JPG')
     images = CameraCalibrator.load_images(image_paths)
     calibrator = CameraCalibrator(chessboard_edges=(9, 6), image_dimensions=(4032, 2268))
-    mtx, dist = calibrator.calibration_parameters(images)
-    test_image = images[0]
+    mtx, dist = calibrator.calibration_parameters(image_paths, mtx_path='mtx_05zoom', dist_path='dist_05zoom')
+    test_image = cv2.imread(image_paths[0])
     corrected_img, cropped_img = calibrator.distortion_correction(test_image)
     cv2.imshow('Corrected Image', corrected_img)
     cv2.imshow('Cropped Image', cropped_img)
@@ -22,35 +110,82 @@ if __name__ == "__main__":
     cv2.destroyAllWindows()
 """
 class DistortionCorrection:
-    def __init__(self, chessboardEdges, image_dimensions):
+    def __init__(self, chessboardEdges, image_dimensions=None):
         self.chessboard_edges = chessboardEdges
+        # Not used, the image size comes from the images themselves. Kept for existing callers
         self.image_dimensions = image_dimensions
         self.mtx = None
         self.dist = None
+        # Undistortion remap tables, keyed by calibration, input size and output size
+        self._map_cache = {}
     
     """
         Not used in demo. We run it before the demo to get the calibration parameters
+        Inputs:
+        - input_images: image file paths and/or already decoded BGR images
+        - mtx_path, dist_path: where to write the results, in the format load_calibration_file reads.
+          New files by default, so a calibration run never overwrites the tracked mtx / dist files
+        - cache_dir: per-image corners are cached here by file hash, so adding a photo only
+          processes that photo. None disables the cache
+        - workers: corner detection processes for file paths, defaults to the CPU count
+        Outputs:
+        - mtx, dist
     """
-    def calibration_parameters(self, input_images):
-        criteria = (cv.TERM_CRITERIA_EPS + cv.TERM_CRITERIA_MAX_ITER, 30, 0.001)
+    def calibration_parameters(self, input_images, mtx_path='mtx_calibrated', dist_path='dist_calibrated',
+                               cache_dir='.livelens_cache/corners', workers=None):
         objp = np.zeros((self.chessboard_edges[0]*self.chessboard_edges[1],3), np.float32)
         objp[:,:2] = np.mgrid[0:self.chessboard_edges[0], 0:self.chessboard_edges[1]].T.reshape(-1,2)
         objpoints = []
         imgpoints = []
-        
-        for image in input_images:
-            gray = cv.cvtColor(image, cv.COLOR_BGR2GRAY)
-            ret, corners = cv.findChessboardCorners(gray, self.chessboard_edges, None)
-            if ret:
-                objpoints.append(objp)
-                corners2 = cv.cornerSubPix(gray, corners, (11,11), (-1,-1), criteria)
-                imgpoints.append(corners2)
-        
-        ret, mtx, dist, rvecs, tvecs = cv.calibrateCamera(objpoints, imgpoints, gray.shape[::-1], None, None)
+        image_size = None
+
+        for path, size, corners in self.detect_corners(input_images, cache_dir, workers):
+            if corners is None:
+                print(f"No chessboard found in {path}")
+                continue
+            if image_size is None:
+                image_size = size
+            elif size != image_size:
+                print(f"Skipping {path}, its size {size} differs from {image_size}")
+                continue
+            objpoints.append(objp)
+            imgpoints.append(corners)
+        if not objpoints:
+            raise ValueError("No chessboard found in any calibration image")
+        print(f"Calibrating on {len(objpoints)} images")
+
+        ret, mtx, dist, rvecs, tvecs = cv.calibrateCamera(objpoints, imgpoints, image_size, None, None)
         self.mtx, self.dist = mtx, dist
-        np.savetxt('mtx.csv', mtx, delimiter=',')
-        np.savetxt('dist.csv', dist, delimiter=',')
+        # Same layout as mtx_05zoom / dist_05zoom
+        np.savetxt(mtx_path, mtx, delimiter=',')
+        np.savetxt(dist_path, dist.reshape(-1, 1), delimiter=',')
+        print(f"Reprojection error {ret:.4f}, wrote {mtx_path} and {dist_path}")
         return mtx, dist
+
+    """
+        detect_corners yields (path or index, image size, corners) per input, in input order.
+        File paths are decoded inside a process pool one at a time, so the images are never all
+        in memory, decoded images are searched in this process
+    """
+    def detect_corners(self, input_images, cache_dir=None, workers=None):
+        input_images = list(input_images)
+        for index, image in enumerate(input_images):
+            if not isinstance(image, (str, os.PathLike, np.ndarray)):
+                raise TypeError(f"Calibration input {index} is a {type(image).__name__}, "
+                                f"expected a file path or a BGR image")
+        paths = [str(image) for image in input_images if not isinstance(image, np.ndarray)]
+        if not paths:
+            for index, image in enumerate(input_images):
+                yield self.detect_image_corners(index, image)
+            return
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_calibration_worker) as pool:
+            file_corners = pool.map(detect_file_corners, paths, repeat(self.chessboard_edges), repeat(cache_dir))
+            for index, image in enumerate(input_images):
+                yield self.detect_image_corners(index, image) if isinstance(image, np.ndarray) else next(file_corners)
+
+    def detect_image_corners(self, index, image):
+        gray = cv.cvtColor(image, cv.COLOR_BGR2GRAY)
+        return index, gray.shape[::-1], find_corners(gray, self.chessboard_edges)
     """
         distortion_correction takes an input image and remaps the pixels based on the distortion parameters   
         Inputs:
@@ -61,17 +196,90 @@ class DistortionCorrection:
         - cropped_img: the remapped image with a cropped edge
     """
     def distortion_correction(self, img):
-        print(f"Image size: {img.size}", img.shape[:2])
-        print(f"mtx: {self.mtx}, dist: {self.dist}")
         h, w = img.shape[:2]
-        new_camera_matrix, roi = cv.getOptimalNewCameraMatrix(self.mtx, self.dist, (w,h), 1, (w,h))
-        # undistort
-        corrected_img = cv.undistort(img, self.mtx, self.dist, None, new_camera_matrix)
+        map1, map2, roi = self.get_undistort_maps((w, h))
+        # undistort with the cached remap tables
+        corrected_img = cv.remap(img, map1, map2, cv.INTER_LINEAR)
         # crop the image
         x, y, w, h = roi
         cropped_img = corrected_img[y:y+h, x:x+w]
         return corrected_img, cropped_img
 
+    """
+        undistort_resized undistorts and resizes in a single remap pass, e.g. straight to the
+        640x480 segmentation input
+        Inputs:
+        - img: the input image
+        - output_size: (width, height) of the returned image
+        - calibration_size: optional (width, height) the image is treated as having been resized to
+          before undistortion, e.g. the 1900x1425 still image size for video frames of another size
+        Outputs:
+        - the undistorted image at output_size
+    """
+    def undistort_resized(self, img, output_size, calibration_size=None):
+        h, w = img.shape[:2]
+        map1, map2, _ = self.get_undistort_maps((w, h), output_size, calibration_size)
+        return cv.remap(img, map1, map2, cv.INTER_LINEAR)
+
+    """
+        get_undistort_maps builds the initUndistortRectifyMap tables once per
+        (calibration, input size, output size) and keeps them in fixed point (CV_16SC2) form
+        Outputs:
+        - map1, map2: tables for cv.remap
+        - roi: valid pixel region of the output image as (x, y, w, h)
+    """
+    def get_undistort_maps(self, input_size, output_size=None, calibration_size=None):
+        if output_size is None:
+            output_size = input_size
+        input_size = (int(input_size[0]), int(input_size[1]))
+        output_size = (int(output_size[0]), int(output_size[1]))
+        calibration_size = input_size if calibration_size is None \
+            else (int(calibration_size[0]), int(calibration_size[1]))
+        mtx = np.asarray(self.mtx, dtype=np.float64)
+        dist = np.asarray(self.dist, dtype=np.float64)
+        key = (mtx.tobytes(), dist.tobytes(), input_size, output_size, calibration_size)
+        maps = self._map_cache.get(key)
+        if maps is not None:
+            return maps
+        new_camera_matrix, roi = self.output_camera_matrix(calibration_size, output_size)
+        if calibration_size == input_size:
+            map1, map2 = cv.initUndistortRectifyMap(mtx, dist, None, new_camera_matrix, output_size, cv.CV_16SC2)
+        else:
+            # Fold the resize to calibration_size into the tables too, by scaling the source coordinates
+            map_x, map_y = cv.initUndistortRectifyMap(mtx, dist, None, new_camera_matrix, output_size, cv.CV_32FC1)
+            map_x = (map_x + 0.5) * (input_size[0] / calibration_size[0]) - 0.5
+            map_y = (map_y + 0.5) * (input_size[1] / calibration_size[1]) - 0.5
+            map1, map2 = cv.convertMaps(map_x, map_y, cv.CV_16SC2)
+        maps = (map1, map2, tuple(roi))
+        self._map_cache[key] = maps
+        return maps
+
+    """
+        output_camera_matrix returns the camera matrix of the undistorted image at output_size,
+        e.g. to turn mask pixels of the 640x480 segmentation input into calibrated measurements
+        Outputs:
+        - 3x3 camera matrix of the undistorted output image
+        - roi: valid pixel region of the output image as (x, y, w, h)
+    """
+    def output_camera_matrix(self, calibration_size, output_size=None):
+        calibration_size = (int(calibration_size[0]), int(calibration_size[1]))
+        output_size = calibration_size if output_size is None else (int(output_size[0]), int(output_size[1]))
+        mtx = np.asarray(self.mtx, dtype=np.float64)
+        dist = np.asarray(self.dist, dtype=np.float64)
+        new_camera_matrix, roi = cv.getOptimalNewCameraMatrix(mtx, dist, calibration_size, 1, calibration_size)
+        if output_size != calibration_size:
+            # Fold the resize into the camera matrix, keeping pixel centres aligned
+            sx = output_size[0] / calibration_size[0]
+            sy = output_size[1] / calibration_size[1]
+            new_camera_matrix = new_camera_matrix.copy()
+            new_camera_matrix[0, 0] *= sx
+            new_camera_matrix[0, 2] = (new_camera_matrix[0, 2] + 0.5) * sx - 0.5
+            new_camera_matrix[1, 1] *= sy
+            new_camera_matrix[1, 2] = (new_camera_matrix[1, 2] + 0.5) * sy - 0.5
+            x, y, w, h = roi
+            roi = (int(round(x * sx)), int(round(y * sy)), int(round(w * sx)), int(round(h * sy)))
+        return new_camera_matrix, tuple(roi)
+
     def load_images(self, image_paths):
         images = []
         for path in image_paths:
@@ -81,24 +289,28 @@ class DistortionCorrection:
         return images
     
 if __name__ == "__main__":
-    image_dir = "Open_CV_Files"  # Replace with your images directory
+    parser = argparse.ArgumentParser(description="Calibrate the camera from chessboard photos")
+    parser.add_argument('image_dir', nargs='?', default="Open_CV_Files")  # Replace with your images directory
+    parser.add_argument('--pattern', default='*.JPG')
+    # New files by default, the tracked mtx / dist and *_05zoom files are only replaced on request
+    parser.add_argument('--mtx', default='mtx_calibrated', help="Output camera matrix file, e.g. mtx_05zoom")
+    parser.add_argument('--dist', default='dist_calibrated', help="Output distortion coefficients file, e.g. dist_05zoom")
+    parser.add_argument('--workers', type=int, default=None, help="Corner detection processes")
+    parser.add_argument('--cache-dir', default='.livelens_cache/corners')
+    parser.add_argument('--no-cache', action='store_true', help="Detect the corners of every image again")
+    parser.add_argument('--show', action='store_true', help="Show the first image corrected")
+    args = parser.parse_args()
     # grabs all da files, glob style  ;)
     # Jank but works, "Files" is not the shared "Files" folder on the drive but a shortcut in my personal drive to the shared capstone Files folder
-    image_paths = glob.glob(f'{image_dir}/*.JPG')
-    image_list = []
-    for path in image_paths:
-        img = cv.imread(path)
-        img = np.array(img)
-        image_list.append(img)
-    print(image_list[0].size)
-    images = image_list
+    image_paths = sorted(glob.glob(os.path.join(args.image_dir, args.pattern)))
+    print(f"Found {len(image_paths)} images")
     calibrator = DistortionCorrection(chessboardEdges=(9, 6), image_dimensions=(16, 9))
-    mtx, dist = calibrator.calibration_parameters(images)
-    test_image = cv.imread(image_paths[0])
-    corrected_img, cropped_img = calibrator.distortion_correction(test_image)
-    cv.imshow('Corrected Image', corrected_img)
-    cv.imshow('Cropped Image', cropped_img)
-    cv.waitKey(0)
-    cv.destroyAllWindows()
-
-        
\ No newline at end of file
+    mtx, dist = calibrator.calibration_parameters(image_paths, args.mtx, args.dist,
+                                                  None if args.no_cache else args.cache_dir, args.workers)
+    if args.show:
+        test_image = cv.imread(image_paths[0])
+        corrected_img, cropped_img = calibrator.distortion_correction(test_image)
+        cv.imshow('Corrected Image', corrected_img)
+        cv.imshow('Cropped Image', cropped_img)
+        cv.waitKey(0)
+        cv.destroyAllWindows()
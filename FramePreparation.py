@@ -0,0 +1,71 @@
+import cv2 as cv
+from PIL import Image
+
+"""
+Usage:
+    image = decode('Images/459_s_199_F.jpg')         # BGR, at least WORKING_SIZE
+    working_frame = fit(image, WORKING_SIZE)         # BGR 1900x1425
+
+Every image in the pipeline is BGR: the order OpenCV decodes to, YOLO takes and the weight
+predictor was fed. The displays show it through QImage.Format_BGR888, so no frame is converted
+between color orders anywhere. JPEGs much larger than the working frame are decoded straight
+at 1/2, 1/4 or 1/8 scale by libjpeg, which skips most of the decode work and the full size
+allocation.
+"""
+
+# Size every still image is brought to before undistortion, the calibration files assume it
+WORKING_SIZE = (1900, 1425)
+# Input size of the segmentation model, processed_image everywhere
+MODEL_INPUT_SIZE = (640, 480)
+
+REDUCED_FLAGS = ((8, cv.IMREAD_REDUCED_COLOR_8), (4, cv.IMREAD_REDUCED_COLOR_4), (2, cv.IMREAD_REDUCED_COLOR_2))
+
+
+# EXIF orientations that rotate the image by 90 degrees, cv.imread applies them while decoding
+TRANSPOSED_ORIENTATIONS = (5, 6, 7, 8)
+
+
+def image_size(path):
+    # (width, height) as cv.imread returns it, from the file header without decoding the pixels,
+    # None if unreadable
+    try:
+        with Image.open(path) as image:
+            width, height = image.size
+            if image.getexif().get(0x0112) in TRANSPOSED_ORIENTATIONS:
+                width, height = height, width
+            return width, height
+    except OSError:
+        return None
+
+
+"""
+    reduced_decode_flag picks the largest decode reduction that still leaves the image at
+    least target_size on both axes, since fit() resizes to target_size as it is. A portrait
+    image is stretched to the landscape working frame, so its width decides the reduction
+"""
+def reduced_decode_flag(source_size, target_size):
+    source_width, source_height = source_size
+    target_width, target_height = target_size
+    for factor, flag in REDUCED_FLAGS:
+        if source_width // factor >= target_width and source_height // factor >= target_height:
+            return flag
+    return cv.IMREAD_COLOR
+
+
+def decode(path, target_size=WORKING_SIZE):
+    path = str(path)
+    source_size = image_size(path)
+    flag = cv.IMREAD_COLOR if source_size is None else reduced_decode_flag(source_size, target_size)
+    image = cv.imread(path, flag)
+    if image is None:
+        raise IOError(f"Failed to load image at {path}")
+    return image
+
+
+def fit(image, size):
+    # Resize to size unless it already is. INTER_AREA only for shrinking by 2x or more, below that
+    # INTER_LINEAR does not alias and is several times faster
+    if image.shape[1::-1] == tuple(size):
+        return image
+    shrinking = image.shape[1] >= 2 * size[0] or image.shape[0] >= 2 * size[1]
+    return cv.resize(image, tuple(size), interpolation=cv.INTER_AREA if shrinking else cv.INTER_LINEAR)
@@ -0,0 +1,265 @@
+import argparse
+import glob
+import json
+import numpy as np
+import cv2 as cv
+from DistortionCorrection import DistortionCorrection, load_calibration_file
+from FramePreparation import MODEL_INPUT_SIZE, WORKING_SIZE
+
+"""
+Usage:
+    # Fit the regression on the labeled images (id_s_weight_sex.jpg, weight in kg)
+    python GeometricWeightEstimator.py fit --images "Images/*.jpg" --output geometric_weights.json
+
+    # Gated: the geometric weight where it is trusted, ResNet50 for the rest
+    estimator = GeometricWeightEstimator('geometric_weights.json')
+    pipeline = CowPipeline(segmentation_model, distortion_correction, weight_predictor,
+                           weight_estimator=estimator)
+    animals = pipeline.predict_animals(processed_image, result)
+
+    # Or main.py with LIVELENS_WEIGHT_ESTIMATOR=geometric_weights.json
+
+The estimator weighs an animal from its segmentation mask alone, in a few milliseconds instead of
+a ResNet50 forward pass. Mask pixels of the undistorted 640x480 frame are mapped to normalized
+camera coordinates with the calibrated camera matrix, so the measurements do not depend on the
+image resolution: projected area, body length along the principal axis, a heart girth proxy
+(the body depth behind the shoulders, from the thickest slices across the body), solidity and
+two Hu moments of the mask. The camera sits at a fixed distance from the chute, so that
+distance is absorbed by a ridge regression of log weight on these features.
+
+Every estimate comes with the regression's prediction interval. With fallback (the default) an
+animal goes to CowWeightPredictor when that interval is wider than max_relative_std (set with
+fit --max-relative-std and stored in the JSON file), when the segmentation confidence is low,
+when a feature lies outside the range the regression was fitted on or when the mask touches the
+frame border (the animal is cut off).
+"""
+
+FORMAT_VERSION = 1
+FEATURES = ('log_area', 'log_length', 'log_girth', 'solidity', 'hu1', 'hu2')
+# Slices across the body for the girth proxy, the outer ones hold the head and the tail
+SLICES = 20
+MIN_MASK_PIXELS = 200
+
+
+def output_camera_matrix(mtx_path='mtx_05zoom', dist_path='dist_05zoom', calibration_size=WORKING_SIZE,
+                         output_size=MODEL_INPUT_SIZE):
+    # Camera matrix of the frames SegmentationModel sees, see CowPipeline.segmentation_input
+    distortion_correction = DistortionCorrection((9, 6), (4032, 2268))
+    distortion_correction.mtx = load_calibration_file(mtx_path)
+    distortion_correction.dist = load_calibration_file(dist_path)
+    return distortion_correction.output_camera_matrix(calibration_size, output_size)[0]
+
+
+"""
+    mask_measurements computes the calibrated body measurements of one mask
+    Inputs:
+    - mask: boolean mask cropped to its box, as in SegmentationResult.masks
+    - offset: (x, y) of the box in the undistorted frame
+    - camera_matrix: camera matrix of that frame
+    Outputs:
+    - dict with area, length, girth (normalized camera units), solidity, hu1 and hu2,
+      None for masks too small to measure
+"""
+def mask_measurements(mask, offset, camera_matrix):
+    ys, xs = np.nonzero(mask)
+    if len(xs) < MIN_MASK_PIXELS:
+        return None
+    fx, fy = camera_matrix[0, 0], camera_matrix[1, 1]
+    # Normalized camera coordinates, the principal point cancels out of every measurement below
+    u = (xs + offset[0]) / fx
+    v = (ys + offset[1]) / fy
+    pixel_area = 1.0 / (fx * fy)
+    points = np.stack([u - u.mean(), v - v.mean()])
+    _, axes = np.linalg.eigh(points @ points.T)
+    along = axes[:, 1] @ points
+    # Robust ends of the body along the principal axis, a stray pixel does not stretch it
+    start, end = np.percentile(along, [0.5, 99.5])
+    length = max(end - start, 1e-9)
+    # Mean depth of each slice across the body is its area over its width
+    slices = np.clip(((along - start) / length * SLICES).astype(np.int64), 0, SLICES - 1)
+    depth = np.bincount(slices, minlength=SLICES) * pixel_area / (length / SLICES)
+    girth = float(np.percentile(depth[2:-2], 90))
+
+    mask_u8 = mask.astype(np.uint8)
+    contours, _ = cv.findContours(mask_u8, cv.RETR_EXTERNAL, cv.CHAIN_APPROX_SIMPLE)
+    hull_area = cv.contourArea(cv.convexHull(max(contours, key=cv.contourArea)))
+    hu = cv.HuMoments(cv.moments(mask_u8, binaryImage=True)).ravel()
+    return {
+        'area': len(xs) * pixel_area,
+        'length': float(length),
+        'girth': girth,
+        'solidity': float(min(1.0, len(xs) / hull_area)) if hull_area > 0 else 1.0,
+        # Log scaled like usual, the raw moments span many orders of magnitude
+        'hu1': float(-np.sign(hu[0]) * np.log10(abs(hu[0]) + 1e-30)),
+        'hu2': float(-np.sign(hu[1]) * np.log10(abs(hu[1]) + 1e-30)),
+    }
+
+
+def feature_vector(measurements):
+    return np.array([np.log(measurements['area']), np.log(measurements['length']),
+                     np.log(max(measurements['girth'], 1e-9)), measurements['solidity'],
+                     measurements['hu1'], measurements['hu2']], dtype=np.float64)
+
+
+def touches_border(mask_box, image_shape, margin=2):
+    x1, y1, x2, y2 = mask_box
+    height, width = image_shape[:2]
+    return x1 <= margin or y1 <= margin or x2 >= width - margin or y2 >= height - margin
+
+
+"""
+    fit_regression fits log(weight) on standardized features with a ridge penalty (the intercept
+    is not penalized) and keeps what the prediction interval needs, together with the
+    max_relative_std the gated mode uses with this fit
+    Outputs:
+    - the regression parameters, as stored in the JSON file GeometricWeightEstimator loads
+"""
+def fit_regression(features, weights_kg, ridge=1.0, max_relative_std=0.1):
+    features = np.asarray(features, dtype=np.float64)
+    targets = np.log(np.asarray(weights_kg, dtype=np.float64))
+    samples, count = features.shape
+    if samples < count + 2:
+        raise ValueError(f"Need at least {count + 2} labeled animals to fit {count} features, got {samples}")
+    mean = features.mean(axis=0)
+    scale = features.std(axis=0)
+    scale[scale == 0] = 1.0
+    design = np.hstack([np.ones((samples, 1)), (features - mean) / scale])
+    penalty = ridge * np.eye(count + 1)
+    penalty[0, 0] = 0.0
+    covariance = np.linalg.inv(design.T @ design + penalty)
+    coefficients = covariance @ design.T @ targets
+    residuals = targets - design @ coefficients
+    sigma = float(np.sqrt(residuals @ residuals / max(1, samples - count - 1)))
+    # Leave-one-out residuals from the hat matrix diagonal, without refitting
+    leverage = np.einsum('ij,jk,ik->i', design, covariance, design)
+    loo_predictions = np.exp(targets - residuals / np.maximum(1.0 - leverage, 1e-6))
+    return {
+        'format_version': FORMAT_VERSION,
+        'features': list(FEATURES),
+        'mean': mean.tolist(),
+        'scale': scale.tolist(),
+        'minimum': features.min(axis=0).tolist(),
+        'maximum': features.max(axis=0).tolist(),
+        'coefficients': coefficients.tolist(),
+        'covariance': covariance.tolist(),
+        'sigma': sigma,
+        'ridge': ridge,
+        'max_relative_std': max_relative_std,
+        'samples': samples,
+        'fit_mae_kg': float(np.mean(np.abs(np.exp(design @ coefficients) - np.exp(targets)))),
+        'loo_mae_kg': float(np.mean(np.abs(loo_predictions - np.exp(targets)))),
+    }
+
+
+class GeometricWeightEstimator:
+    def __init__(self, model_path, mtx_path='mtx_05zoom', dist_path='dist_05zoom', max_relative_std=None,
+                 min_confidence=0.5, fallback=True):
+        with open(model_path) as f:
+            parameters = json.load(f)
+        if parameters.get('format_version') != FORMAT_VERSION or tuple(parameters['features']) != FEATURES:
+            raise ValueError(f"{model_path} was fitted for other features, fit it again")
+        self.parameters = parameters
+        self.mean = np.asarray(parameters['mean'])
+        self.scale = np.asarray(parameters['scale'])
+        self.coefficients = np.asarray(parameters['coefficients'])
+        self.covariance = np.asarray(parameters['covariance'])
+        self.sigma = parameters['sigma']
+        # Features may lie a tenth of the fitted range beyond it before the estimate is not trusted
+        margin = 0.1 * (np.asarray(parameters['maximum']) - np.asarray(parameters['minimum']))
+        self.minimum = np.asarray(parameters['minimum']) - margin
+        self.maximum = np.asarray(parameters['maximum']) + margin
+        self.camera_matrix = output_camera_matrix(mtx_path, dist_path)
+        # The threshold chosen at fit time unless the caller overrides it
+        self.max_relative_std = max_relative_std if max_relative_std is not None \
+            else parameters.get('max_relative_std', 0.1)
+        self.min_confidence = min_confidence
+        # Without fallback every measurable animal keeps its geometric weight and no ResNet is needed
+        self.fallback = fallback
+
+    def predict(self, features):
+        # Weight in kg and the standard deviation of the log weight, i.e. the relative error
+        row = np.concatenate([[1.0], (features - self.mean) / self.scale])
+        log_weight = row @ self.coefficients
+        log_std = self.sigma * np.sqrt(1.0 + row @ self.covariance @ row)
+        return float(np.exp(log_weight)), float(log_std)
+
+    """
+        estimate weighs instance index of a SegmentationResult of the 640x480 frame
+        Outputs:
+        - dict with weight (kg, None when the mask cannot be measured), relative_std and
+          reason, which says why the estimate is not trusted and is None otherwise
+    """
+    def estimate(self, result, index):
+        measurements = mask_measurements(result.masks[index], result.mask_boxes[index][:2], self.camera_matrix)
+        if measurements is None:
+            return {'weight': None, 'relative_std': None, 'reason': 'mask too small'}
+        features = feature_vector(measurements)
+        weight, relative_std = self.predict(features)
+        reason = None
+        if touches_border(result.mask_boxes[index], result.image_shape):
+            reason = 'animal cut off by the frame'
+        elif result.confidences[index] < self.min_confidence:
+            reason = 'low segmentation confidence'
+        elif np.any(features < self.minimum) or np.any(features > self.maximum):
+            reason = 'outside the fitted range'
+        elif relative_std > self.max_relative_std:
+            reason = f"uncertain, +-{relative_std:.0%}"
+        return {'weight': weight, 'relative_std': relative_std, 'reason': reason}
+
+    def accepts(self, estimate):
+        if not self.fallback:
+            return estimate['weight'] is not None
+        return estimate['reason'] is None
+
+
+def labeled_measurements(image_paths, pipeline):
+    # Measurements of the first detected animal of every labeled image that shows it whole
+    from CowPipeline import parse_image_name
+    camera_matrix = output_camera_matrix(pipeline.mtx_path, pipeline.dist_path)
+    features = []
+    weights = []
+    for path in image_paths:
+        try:
+            _, weight_kg, _ = parse_image_name(path)
+            _, result = pipeline.segment(pipeline.segmentation_input(pipeline.load(path)))
+        except (IndexError, ValueError, IOError) as e:
+            print(f"Skipping {path}: {e}")
+            continue
+        if len(result) == 0 or touches_border(result.mask_boxes[0], result.image_shape):
+            print(f"Skipping {path}: no whole animal detected")
+            continue
+        measurements = mask_measurements(result.masks[0], result.mask_boxes[0][:2], camera_matrix)
+        if measurements is not None:
+            features.append(feature_vector(measurements))
+            weights.append(weight_kg)
+    return features, weights
+
+
+if __name__ == "__main__":
+    from SegmentationModel import SegmentationModel
+    from CowPipeline import CowPipeline
+
+    parser = argparse.ArgumentParser(description="Fit the geometric weight regression on labeled images")
+    commands = parser.add_subparsers(dest='command', required=True)
+    fit = commands.add_parser('fit')
+    fit.add_argument('--images', default='Images/*.jpg', help="Glob of id_s_weight_sex.jpg images")
+    fit.add_argument('--segmentation-weights', default='yolov8m-seg.pt')
+    fit.add_argument('--output', default='geometric_weights.json')
+    fit.add_argument('--ridge', type=float, default=1.0, help="Ridge penalty on the standardized features")
+    fit.add_argument('--max-relative-std', type=float, default=0.1,
+                     help="Prediction interval above which the gated mode falls back to ResNet, "
+                          "stored with the fit")
+    args = parser.parse_args()
+
+    pipeline = CowPipeline(SegmentationModel(args.segmentation_weights), DistortionCorrection((9, 6), (4032, 2268)),
+                           None)
+    features, weights = labeled_measurements(sorted(glob.glob(args.images)), pipeline)
+    parameters = fit_regression(features, weights, args.ridge, args.max_relative_std)
+    with open(args.output, 'w') as f:
+        json.dump(parameters, f, indent=2)
+    estimator = GeometricWeightEstimator(args.output)
+    trusted = sum(estimator.predict(row)[1] <= args.max_relative_std for row in features)
+    print(f"Fitted {len(features)} animals: MAE {parameters['fit_mae_kg']:.1f} kg, "
+          f"leave-one-out MAE {parameters['loo_mae_kg']:.1f} kg, residual std {parameters['sigma']:.1%}")
+    print(f"{trusted}/{len(features)} would be weighed without ResNet at +-{args.max_relative_std:.0%}")
+    print(f"Wrote {args.output}")
@@ -0,0 +1,241 @@
+import argparse
+import glob
+import json
+import os
+import tempfile
+import numpy as np
+import cv2 as cv
+
+"""
+Usage:
+    # Export both models to ONNX, with int8 variants calibrated on Images/
+    python InferenceBackends.py export --onnx --int8 --calibration "Images/*.jpg"
+    # Or to OpenVINO IR
+    python InferenceBackends.py export --openvino
+
+    # Compare a candidate backend against the reference frameworks
+    python InferenceBackends.py check --segmentation yolov8m-seg.onnx \
+        --predictor weights.03.int8.onnx --predictor-backend onnx --images "Images/*.jpg"
+
+    # Then run the app on them
+    LIVELENS_SEGMENTATION_MODEL=yolov8m-seg.onnx LIVELENS_PREDICTOR_BACKEND=onnx \
+        LIVELENS_PREDICTOR_MODEL=weights.03.int8.onnx python main.py
+
+CowWeightPredictor runs its forward pass through one of the backends below, each a callable
+taking a uint8 NHWC batch and returning an (N, 1) float array. SegmentationModel needs no backend
+of its own, Ultralytics already runs exported .onnx files and _openvino_model directories with
+the same Results API. Every runtime is imported lazily, so only the one in use is loaded.
+"""
+
+PREDICTOR_BACKENDS = ('keras', 'onnx', 'openvino')
+
+
+class KerasBackend:
+    """
+        Traced TensorFlow forward pass, avoids the per call setup of model.predict
+    """
+    def __init__(self, model, image_size=(224, 224)):
+        import tensorflow as tf
+        self.input_signature = (tf.TensorSpec(shape=(None, image_size[1], image_size[0], 3), dtype=tf.uint8,
+                                              name='image'),)
+        self.function = tf.function(lambda batch: model(tf.cast(batch, tf.float32), training=False),
+                                    input_signature=self.input_signature)
+
+    def __call__(self, batch):
+        return self.function(batch).numpy()
+
+
+class OnnxRuntimeBackend:
+    def __init__(self, model_path, threads=None):
+        import onnxruntime as ort
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if threads:
+            options.intra_op_num_threads = threads
+        self.session = ort.InferenceSession(model_path, options, providers=['CPUExecutionProvider'])
+        self.input = self.session.get_inputs()[0]
+        self.input_dtype = np.uint8 if self.input.type == 'tensor(uint8)' else np.float32
+
+    def __call__(self, batch):
+        return self.session.run(None, {self.input.name: batch.astype(self.input_dtype, copy=False)})[0]
+
+
+class OpenVinoBackend:
+    def __init__(self, model_path, threads=None):
+        import openvino as ov
+        config = {'PERFORMANCE_HINT': 'LATENCY'}
+        if threads:
+            config['INFERENCE_NUM_THREADS'] = threads
+        self.compiled_model = ov.Core().compile_model(model_path, 'CPU', config)
+        self.output = self.compiled_model.output(0)
+
+    def __call__(self, batch):
+        return self.compiled_model(batch)[self.output]
+
+
+def load_predictor_backend(backend, model_path, threads=None):
+    if backend == 'onnx':
+        return OnnxRuntimeBackend(model_path, threads)
+    if backend == 'openvino':
+        return OpenVinoBackend(model_path, threads)
+    raise ValueError(f"Unknown predictor backend {backend}, expected one of {PREDICTOR_BACKENDS}")
+
+
+def export_predictor_onnx(predictor, output_path, opset=17):
+    # The uint8 -> float32 cast is part of the exported graph, like in KerasBackend
+    import tf2onnx
+    tf2onnx.convert.from_function(predictor.forward.function, input_signature=predictor.forward.input_signature,
+                                  opset=opset, output_path=output_path)
+    return output_path
+
+
+def export_openvino(onnx_path, output_path):
+    import openvino as ov
+    ov.save_model(ov.convert_model(onnx_path), output_path)
+    return output_path
+
+
+def export_segmentation(model_path, export_format, imgsz=(480, 640)):
+    from ultralytics import YOLO
+    # Fixed 640x480 input, the only size the pipeline feeds the model
+    return YOLO(model_path).export(format=export_format, imgsz=imgsz)
+
+
+def calibration_frames(image_paths, limit=64):
+    # Undistorted 640x480 BGR frames, exactly what the pipeline feeds both models
+    from DistortionCorrection import DistortionCorrection
+    from CowPipeline import CowPipeline
+    pipeline = CowPipeline(None, DistortionCorrection((9, 6), (4032, 2268)), None)
+    for path in image_paths[:limit]:
+        image = pipeline.load(path)
+        yield pipeline.segmentation_input(image)
+
+
+class _CalibrationReader:
+    def __init__(self, input_name, inputs):
+        self.input_name = input_name
+        self.inputs = iter(inputs)
+
+    def get_next(self):
+        value = next(self.inputs, None)
+        return None if value is None else {self.input_name: value}
+
+
+"""
+    quantize_onnx writes a static int8 (QDQ) copy of an ONNX model, calibrated on the given inputs
+"""
+def quantize_onnx(float_path, int8_path, calibration_inputs):
+    import onnxruntime as ort
+    from onnxruntime.quantization import QuantFormat, QuantType, quantize_static
+    input_name = ort.InferenceSession(float_path, providers=['CPUExecutionProvider']).get_inputs()[0].name
+    quantize_static(float_path, int8_path, _CalibrationReader(input_name, calibration_inputs),
+                    quant_format=QuantFormat.QDQ, per_channel=True,
+                    activation_type=QuantType.QUInt8, weight_type=QuantType.QInt8)
+    return int8_path
+
+
+def predictor_calibration_inputs(frames, image_size=(224, 224)):
+    for frame in frames:
+        yield cv.resize(frame, image_size)[None]
+
+
+def segmentation_calibration_inputs(frames):
+    # YOLO's ONNX input: RGB, NCHW, float32 in 0..1
+    for frame in frames:
+        yield np.ascontiguousarray(cv.cvtColor(frame, cv.COLOR_BGR2RGB).transpose(2, 0, 1)[None],
+                                   dtype=np.float32) / 255.0
+
+
+def mask_iou(a, b):
+    union = np.logical_or(a, b).sum()
+    return 1.0 if union == 0 else float(np.logical_and(a, b).sum() / union)
+
+
+"""
+    compare_backends runs the reference and candidate models on the same frames and reports
+    the mask IoU and the weight difference of the candidate
+"""
+def compare_backends(frames, reference_segmentation, candidate_segmentation,
+                     reference_predictor, candidate_predictor):
+    ious = []
+    weight_errors = []
+    for frame in frames:
+        image = reference_segmentation.preprocess_image(frame)
+        if candidate_segmentation is not None:
+            reference = reference_segmentation.segment(image)
+            candidate = candidate_segmentation.segment(image)
+            ious.append(mask_iou(reference.label_mask() > 0, candidate.label_mask() > 0))
+        if candidate_predictor is not None:
+            reference_weight = reference_predictor.predict_batch([image])[0]
+            candidate_weight = candidate_predictor.predict_batch([image])[0]
+            weight_errors.append(abs(float(candidate_weight - reference_weight)))
+    report = {'frames': len(ious) or len(weight_errors)}
+    if ious:
+        report.update(mean_mask_iou=float(np.mean(ious)), min_mask_iou=float(np.min(ious)))
+    if weight_errors:
+        report.update(mean_weight_error_kg=float(np.mean(weight_errors)),
+                      max_weight_error_kg=float(np.max(weight_errors)))
+    return report
+
+
+if __name__ == "__main__":
+    from SegmentationModel import SegmentationModel
+    from CowWeightPredictor import CowWeightPredictor
+
+    parser = argparse.ArgumentParser(description="Export the models to CPU runtimes and check their accuracy")
+    commands = parser.add_subparsers(dest='command', required=True)
+    export = commands.add_parser('export')
+    export.add_argument('--segmentation-weights', default='yolov8m-seg.pt')
+    export.add_argument('--predictor-weights', default='weights.03.hdf5')
+    export.add_argument('--onnx', action='store_true')
+    export.add_argument('--openvino', action='store_true')
+    export.add_argument('--int8', action='store_true', help="Also write int8 ONNX models")
+    export.add_argument('--calibration', default='Images/*.jpg', help="Glob of calibration images")
+    check = commands.add_parser('check')
+    check.add_argument('--segmentation-weights', default='yolov8m-seg.pt')
+    check.add_argument('--predictor-weights', default='weights.03.hdf5')
+    check.add_argument('--segmentation', help="Exported segmentation model to check")
+    check.add_argument('--predictor', help="Exported predictor model to check")
+    check.add_argument('--predictor-backend', choices=PREDICTOR_BACKENDS[1:], default='onnx')
+    check.add_argument('--images', default='Images/*.jpg')
+    check.add_argument('--limit', type=int, default=64)
+    args = parser.parse_args()
+
+    if args.command == 'export':
+        if not (args.onnx or args.openvino or args.int8):
+            parser.error("Nothing to export, pass --onnx, --openvino and/or --int8")
+        predictor = CowWeightPredictor(args.predictor_weights)
+        stem = os.path.splitext(args.predictor_weights)[0]
+        if args.onnx or args.int8:
+            predictor_onnx = export_predictor_onnx(predictor, stem + '.onnx')
+            print(f"Wrote {predictor_onnx}")
+            print(f"Wrote {export_segmentation(args.segmentation_weights, 'onnx')}")
+        if args.openvino:
+            if args.onnx or args.int8:
+                print(f"Wrote {export_openvino(predictor_onnx, stem + '.xml')}")
+            else:
+                # OpenVINO converts from ONNX, which is only kept when --onnx asks for it
+                with tempfile.TemporaryDirectory() as temp_dir:
+                    onnx_path = export_predictor_onnx(predictor, os.path.join(temp_dir, 'predictor.onnx'))
+                    print(f"Wrote {export_openvino(onnx_path, stem + '.xml')}")
+            print(f"Wrote {export_segmentation(args.segmentation_weights, 'openvino')}")
+        if args.int8:
+            calibration_paths = sorted(glob.glob(args.calibration))
+            print(f"Calibrating int8 models on {len(calibration_paths)} images")
+            int8_path = quantize_onnx(predictor_onnx, stem + '.int8.onnx',
+                                      predictor_calibration_inputs(calibration_frames(calibration_paths)))
+            print(f"Wrote {int8_path}")
+            segmentation_onnx = os.path.splitext(args.segmentation_weights)[0] + '.onnx'
+            segmentation_int8 = os.path.splitext(args.segmentation_weights)[0] + '.int8.onnx'
+            quantize_onnx(segmentation_onnx, segmentation_int8,
+                          segmentation_calibration_inputs(calibration_frames(calibration_paths)))
+            print(f"Wrote {segmentation_int8}")
+    else:
+        frames = list(calibration_frames(sorted(glob.glob(args.images)), args.limit))
+        reference_segmentation = SegmentationModel(args.segmentation_weights)
+        candidate_segmentation = SegmentationModel(args.segmentation) if args.segmentation else None
+        reference_predictor = CowWeightPredictor(args.predictor_weights) if args.predictor else None
+        candidate_predictor = CowWeightPredictor(args.predictor, backend=args.predictor_backend) \
+            if args.predictor else None
+        print(json.dumps(compare_backends(frames, reference_segmentation, candidate_segmentation,
+                                          reference_predictor, candidate_predictor), indent=2))
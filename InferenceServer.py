@@ -0,0 +1,341 @@
+import argparse
+import itertools
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future, TimeoutError
+from multiprocessing.connection import Client, Listener
+import numpy as np
+from SegmentationModel import SegmentationModel, SegmentationResult
+from CowWeightPredictor import CowWeightPredictor
+from Tracing import tracer
+
+"""
+Usage:
+    # On the shared box, loads both models once. The secret is required, see below
+    export LIVELENS_SERVER_AUTHKEY=$(python -c "import secrets; print(secrets.token_hex(32))")
+    python InferenceServer.py --address 0.0.0.0:7733
+    python InferenceServer.py --address /tmp/livelens.sock     # Unix socket
+
+    # On every kiosk, with the same LIVELENS_SERVER_AUTHKEY, main.py uses the server
+    # instead of loading the models
+    LIVELENS_INFERENCE_SERVER=inference-box:7733 python main.py
+
+    # Or from code
+    client = InferenceClient('127.0.0.1:7733')
+    pipeline = CowPipeline(RemoteSegmentationModel(client), distortion_correction, RemoteWeightPredictor(client))
+
+Requests from all clients are queued per model. A batcher thread per model takes the oldest
+request, waits at most max_latency for more and runs them as one forward pass of up to
+max_batch requests. A full queue answers 'busy' straight away instead of growing, and requests
+still queued past their timeout are answered with an error instead of being run.
+Segmentation results travel bit-packed (SegmentationResult.pack), the weight predictor
+receives the 224x224 batch the client already resized.
+
+Messages are pickled, and unpickling runs arbitrary code, so every connection has to
+authenticate with LIVELENS_SERVER_AUTHKEY. There is no default: the server and the client refuse
+to start without it. Set it to the same long random secret on the server and the kiosks.
+"""
+
+DEFAULT_ADDRESS = '127.0.0.1:7733'
+
+
+class InferenceServerError(RuntimeError):
+    pass
+
+
+def server_authkey(authkey=None):
+    # The shared secret from LIVELENS_SERVER_AUTHKEY unless one is given
+    authkey = authkey or os.environ.get('LIVELENS_SERVER_AUTHKEY')
+    if not authkey:
+        raise InferenceServerError("Set LIVELENS_SERVER_AUTHKEY to a shared secret, connections exchange "
+                                   "pickles and must not be accepted from anyone")
+    return authkey.encode() if isinstance(authkey, str) else authkey
+
+
+def parse_address(address):
+    # host:port for TCP, anything else is a Unix socket path
+    if isinstance(address, tuple):
+        return address
+    host, _, port = address.rpartition(':')
+    if host and port.isdigit() and '/' not in address:
+        return host, int(port)
+    return address
+
+
+class Request:
+    def __init__(self, connection, send_lock, request_id, payload, deadline):
+        self.connection = connection
+        self.send_lock = send_lock
+        self.request_id = request_id
+        self.payload = payload
+        self.deadline = deadline
+
+    def reply(self, result=None, error=None):
+        message = {'id': self.request_id, 'result': result} if error is None \
+            else {'id': self.request_id, 'error': error}
+        try:
+            with self.send_lock:
+                self.connection.send(message)
+        except (OSError, ValueError):
+            # The client went away, nobody is waiting for the answer
+            pass
+
+
+class InferenceServer:
+    def __init__(self, segmentation_model, weight_predictor, address=DEFAULT_ADDRESS, authkey=None,
+                 max_batch=8, max_latency=0.01, max_pending=64, default_timeout=10.0):
+        self.segmentation_model = segmentation_model
+        self.weight_predictor = weight_predictor
+        self.address = parse_address(address)
+        self.authkey = server_authkey(authkey)
+        self.max_batch = max_batch
+        self.max_latency = max_latency
+        self.default_timeout = default_timeout
+        # One bounded queue and batcher per model, the models are only called from their batcher
+        self.queues = {'segment': queue.Queue(max_pending), 'predict': queue.Queue(max_pending)}
+        self.handlers = {'segment': self.run_segment, 'predict': self.run_predict}
+        self.stop_event = threading.Event()
+        self.listener = None
+
+    def serve_forever(self):
+        for op in self.queues:
+            threading.Thread(target=self.batch_loop, args=(op,), name=f'batch-{op}', daemon=True).start()
+        self.listener = Listener(self.address, authkey=self.authkey)
+        print(f"Inference server listening on {self.address}")
+        while not self.stop_event.is_set():
+            try:
+                connection = self.listener.accept()
+            except OSError as e:
+                if self.stop_event.is_set():
+                    break
+                # A failed handshake (e.g. a wrong authkey) only drops that client
+                print(f"Rejected connection: {e}")
+                continue
+            threading.Thread(target=self.handle_connection, args=(connection,), daemon=True).start()
+
+    def shutdown(self):
+        self.stop_event.set()
+        if self.listener is not None:
+            self.listener.close()
+
+    def handle_connection(self, connection):
+        send_lock = threading.Lock()
+        while not self.stop_event.is_set():
+            try:
+                message = connection.recv()
+            except (EOFError, OSError):
+                break
+            timeout = message.get('timeout') or self.default_timeout
+            request = Request(connection, send_lock, message['id'], message.get('payload'),
+                              time.monotonic() + timeout)
+            if message['op'] == 'info':
+                request.reply({'max_batch': self.max_batch, 'max_latency': self.max_latency,
+                               'pending': {op: q.qsize() for op, q in self.queues.items()}})
+                continue
+            requests = self.queues.get(message['op'])
+            if requests is None:
+                request.reply(error=f"Unknown op {message['op']}")
+                continue
+            try:
+                requests.put_nowait(request)
+            except queue.Full:
+                # Backpressure, the client retries or fails instead of the queue growing
+                request.reply(error='busy')
+        connection.close()
+
+    """
+        batch_loop collects requests for one model into micro-batches: it flushes after
+        max_batch requests or max_latency after the first one arrived, whichever comes first
+    """
+    def batch_loop(self, op):
+        requests = self.queues[op]
+        while not self.stop_event.is_set():
+            try:
+                batch = [requests.get(timeout=0.5)]
+            except queue.Empty:
+                continue
+            flush_at = time.monotonic() + self.max_latency
+            while len(batch) < self.max_batch:
+                remaining = flush_at - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(requests.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            now = time.monotonic()
+            live = []
+            for request in batch:
+                if request.deadline < now:
+                    request.reply(error='timed out waiting in the server queue')
+                else:
+                    live.append(request)
+            if not live:
+                continue
+            try:
+                results = self.handlers[op]([request.payload for request in live])
+            except Exception as e:
+                print(f"Batch of {len(live)} {op} requests failed: {e}")
+                for request in live:
+                    request.reply(error=str(e))
+                continue
+            for request, result in zip(live, results):
+                request.reply(result)
+
+    def run_segment(self, images):
+        with tracer.stage('server_segment', batch=[len(images)]):
+            return [result.pack() for result in self.segmentation_model.segment_batch(images)]
+
+    def run_predict(self, batches):
+        # Every request's images go through the predictor as one batch, split again afterwards
+        counts = [len(batch) for batch in batches]
+        with tracer.stage('server_predict', batch=counts):
+            weights = self.weight_predictor.predict_batch(np.concatenate(batches))
+        return np.split(weights, np.cumsum(counts)[:-1])
+
+
+class InferenceClient:
+    """
+        Connection to an InferenceServer, safe to share between threads. At most max_in_flight
+        requests are outstanding, further submits block until an answer comes back
+    """
+    def __init__(self, address=DEFAULT_ADDRESS, authkey=None, timeout=10.0, max_in_flight=8):
+        self.connection = Client(parse_address(address), authkey=server_authkey(authkey))
+        self.timeout = timeout
+        self.pending = {} # Request id to Future
+        self.lock = threading.Lock()
+        self.send_lock = threading.Lock()
+        self.ids = itertools.count()
+        self.in_flight = threading.BoundedSemaphore(max_in_flight)
+        self.closed = False
+        threading.Thread(target=self.receive_loop, name='inference-client', daemon=True).start()
+
+    def submit(self, op, payload=None, timeout=None):
+        timeout = timeout or self.timeout
+        if not self.in_flight.acquire(timeout=timeout):
+            raise InferenceServerError(f"Too many requests in flight for {timeout}s")
+        request_id = next(self.ids)
+        future = Future()
+        future.request_id = request_id
+        future.add_done_callback(lambda _: self.in_flight.release())
+        with self.lock:
+            self.pending[request_id] = future
+        try:
+            with self.send_lock:
+                self.connection.send({'id': request_id, 'op': op, 'payload': payload, 'timeout': timeout})
+        except (OSError, ValueError) as e:
+            self.fail(request_id, InferenceServerError(f"Failed to send request: {e}"))
+        return future
+
+    def call(self, op, payload=None, timeout=None):
+        timeout = timeout or self.timeout
+        future = self.submit(op, payload, timeout)
+        try:
+            return future.result(timeout)
+        except TimeoutError:
+            # Frees the in-flight slot, a late answer is then ignored
+            error = InferenceServerError(f"{op} timed out after {timeout}s")
+            self.fail(future.request_id, error)
+            raise error
+
+    def fail(self, request_id, error):
+        with self.lock:
+            future = self.pending.pop(request_id, None)
+        if future is not None and not future.done():
+            future.set_exception(error)
+
+    def receive_loop(self):
+        while True:
+            try:
+                message = self.connection.recv()
+            except (EOFError, OSError):
+                break
+            with self.lock:
+                future = self.pending.pop(message['id'], None)
+            if future is None:
+                continue # Answer to a request that already timed out
+            if 'error' in message:
+                future.set_exception(InferenceServerError(message['error']))
+            else:
+                future.set_result(message['result'])
+        with self.lock:
+            request_ids = list(self.pending)
+        for request_id in request_ids:
+            self.fail(request_id, InferenceServerError("Connection to the inference server closed"))
+
+    def segment(self, image, timeout=None):
+        return SegmentationResult.unpack(self.call('segment', np.ascontiguousarray(image), timeout))
+
+    def predict(self, batch, timeout=None):
+        return self.call('predict', np.ascontiguousarray(batch), timeout)
+
+    def info(self):
+        return self.call('info')
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.connection.close()
+
+
+class RemoteSegmentationModel(SegmentationModel):
+    """
+        SegmentationModel whose segment runs on the inference server, the rest is unchanged
+    """
+    def __init__(self, client):
+        super().__init__()
+        self.client = client
+
+    def segment(self, image, save=False):
+        return self.client.segment(image)
+
+    def segment_batch(self, images):
+        futures = [self.client.submit('segment', np.ascontiguousarray(image)) for image in images]
+        return [SegmentationResult.unpack(future.result(self.client.timeout)) for future in futures]
+
+
+class RemoteWeightPredictor(CowWeightPredictor):
+    """
+        CowWeightPredictor whose forward pass runs on the inference server. Images are still
+        resized into the local batch buffer, so only 224x224 inputs go over the connection
+    """
+    def __init__(self, client, batch_size=16):
+        self.client = client
+        super().__init__(batch_size=batch_size, backend='remote',
+                         forward=lambda batch: self.client.predict(batch)[:, None])
+
+
+if __name__ == "__main__":
+    from InferenceBackends import PREDICTOR_BACKENDS
+    from ThreadBudget import load_thread_budget
+
+    parser = argparse.ArgumentParser(description="Serve the segmentation and weight models to many clients")
+    parser.add_argument('--address', default=DEFAULT_ADDRESS, help="host:port or a Unix socket path")
+    parser.add_argument('--segmentation-weights', default='yolov8m-seg.pt')
+    parser.add_argument('--predictor-weights', default='weights.03.hdf5')
+    parser.add_argument('--predictor-backend', choices=PREDICTOR_BACKENDS, default='keras')
+    parser.add_argument('--max-batch', type=int, default=8, help="Requests per forward pass")
+    parser.add_argument('--max-latency-ms', type=float, default=10.0,
+                        help="How long the first request of a batch waits for more")
+    parser.add_argument('--max-pending', type=int, default=64, help="Queued requests per model before 'busy'")
+    args = parser.parse_args()
+    try:
+        # Before the models load, a missing secret fails straight away
+        server_authkey()
+    except InferenceServerError as e:
+        parser.error(str(e))
+
+    thread_budget = load_thread_budget()
+    print(f"Using {thread_budget}")
+    thread_budget.apply()
+    server = InferenceServer(SegmentationModel(args.segmentation_weights),
+                             CowWeightPredictor(args.predictor_weights, backend=args.predictor_backend,
+                                                threads=thread_budget.predict_intra),
+                             address=args.address, max_batch=args.max_batch,
+                             max_latency=args.max_latency_ms / 1000.0, max_pending=args.max_pending)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.shutdown()
@@ -1,38 +1,191 @@
 import os
 import numpy as np
-from ultralytics import YOLO
 import cv2 as cv
-import matplotlib.pyplot as plt
+from Tracing import tracer
+# Ultralytics (and with it Torch) and matplotlib are imported lazily so importing this module stays cheap
+
+class SegmentationResult:
+    """
+        Compact segmentation of one frame, built once from the ultralytics results.
+        - boxes: (N, 4) float32 xyxy boxes in working image pixels
+        - confidences: (N,) float32
+        - class_ids: (N,) int32
+        - masks: N boolean arrays, each cropped to its integer box (mask_boxes)
+        - image_shape: (height, width) of the working image
+    """
+    def __init__(self, boxes, confidences, class_ids, mask_boxes, masks, image_shape):
+        self.boxes = boxes
+        self.confidences = confidences
+        self.class_ids = class_ids
+        self.mask_boxes = mask_boxes
+        self.masks = masks
+        self.image_shape = tuple(int(v) for v in image_shape)
+
+    @classmethod
+    def from_ultralytics(cls, results, image_shape):
+        result = results[0]
+        height, width = image_shape[:2]
+        if result.masks is None or len(result.boxes.xyxy) == 0:
+            return cls(np.zeros((0, 4), np.float32), np.zeros(0, np.float32), np.zeros(0, np.int32),
+                       np.zeros((0, 4), np.int32), [], (height, width))
+        boxes = result.boxes.xyxy.cpu().numpy().astype(np.float32)
+        confidences = result.boxes.conf.cpu().numpy().astype(np.float32)
+        class_ids = result.boxes.cls.cpu().numpy().astype(np.int32)
+        # One transfer to numpy for all masks, thresholded in a single vectorized pass
+        masks = result.masks.data.cpu().numpy() > 0.5
+        if masks.shape[1:] != (height, width):
+            masks = np.stack([cv.resize(mask.astype(np.uint8), (width, height), interpolation=cv.INTER_NEAREST)
+                              for mask in masks]).astype(bool)
+        mask_boxes = np.empty((len(boxes), 4), np.int32)
+        mask_boxes[:, 0:2] = np.floor(boxes[:, 0:2])
+        mask_boxes[:, 2:4] = np.ceil(boxes[:, 2:4])
+        mask_boxes[:, 0::2] = mask_boxes[:, 0::2].clip(0, width)
+        mask_boxes[:, 1::2] = mask_boxes[:, 1::2].clip(0, height)
+        cropped = [np.ascontiguousarray(mask[y1:y2, x1:x2]) for mask, (x1, y1, x2, y2) in zip(masks, mask_boxes)]
+        return cls(boxes, confidences, class_ids, mask_boxes, cropped, (height, width))
+
+    def __len__(self):
+        return len(self.boxes)
+
+    def full_mask(self, index=0):
+        mask = np.zeros(self.image_shape, dtype=bool)
+        x1, y1, x2, y2 = self.mask_boxes[index]
+        mask[y1:y2, x1:x2] = self.masks[index]
+        return mask
+
+    def label_mask(self):
+        # 0 for background, i + 1 where instance i is, later instances drawn on top
+        labels = np.zeros(self.image_shape, dtype=np.int32)
+        for index, (x1, y1, x2, y2) in enumerate(self.mask_boxes):
+            labels[y1:y2, x1:x2][self.masks[index]] = index + 1
+        return labels
+
+    """
+        instance_crops returns one box-sized crop per instance with the pixels outside that
+        instance's mask zeroed, ready to be batched through CowWeightPredictor
+    """
+    def instance_crops(self, image):
+        crops = []
+        for (x1, y1, x2, y2), mask in zip(self.mask_boxes, self.masks):
+            crop = image[y1:y2, x1:x2]
+            crops.append(crop * (mask[..., None] if crop.ndim == 3 else mask))
+        return crops
+
+    def filtered(self, image, index=None):
+        # Keep the pixels of one instance, or of every instance when index is None
+        if index is None:
+            labels = self.label_mask() > 0
+            return image * (labels[..., None] if image.ndim == 3 else labels)
+
+        # Only the box region is touched, everything else stays zero
+        filtered_image = np.zeros_like(image)
+        x1, y1, x2, y2 = self.mask_boxes[index]
+        crop = image[y1:y2, x1:x2]
+        mask = self.masks[index]
+        filtered_image[y1:y2, x1:x2] = crop * (mask[..., None] if crop.ndim == 3 else mask)
+        return filtered_image
+
+    """
+        pack returns plain numpy arrays with the masks bit-packed, for caching or sending to
+        another process. unpack rebuilds the result from them
+    """
+    def pack(self):
+        bits = [np.packbits(mask) for mask in self.masks]
+        offsets = np.cumsum([0] + [len(b) for b in bits]).astype(np.int64)
+        return {
+            'boxes': self.boxes,
+            'confidences': self.confidences,
+            'class_ids': self.class_ids,
+            'mask_boxes': self.mask_boxes,
+            'mask_bits': np.concatenate(bits) if bits else np.zeros(0, np.uint8),
+            'mask_offsets': offsets,
+            'image_shape': np.array(self.image_shape),
+        }
+
+    @classmethod
+    def unpack(cls, packed):
+        masks = []
+        offsets = packed['mask_offsets']
+        for i, (x1, y1, x2, y2) in enumerate(packed['mask_boxes']):
+            shape = (int(y2 - y1), int(x2 - x1))
+            bits = packed['mask_bits'][offsets[i]:offsets[i + 1]]
+            masks.append(np.unpackbits(bits, count=shape[0] * shape[1]).reshape(shape).astype(bool))
+        return cls(packed['boxes'], packed['confidences'], packed['class_ids'], packed['mask_boxes'],
+                   masks, packed['image_shape'])
+
 
 class SegmentationModel:
-    def __init__(self, model_path):
-        self.model = YOLO(model_path)
+    """
+        model_path loads YOLO. Without it model is used as is, any object with YOLO's predict
+        (None for the subclasses that run segment elsewhere), and classes filters the detections
+    """
+    def __init__(self, model_path=None, conf=0.25, model=None, classes=None):
+        self.model = model
+        self.conf = conf
+        self.classes = classes
+        if model_path is None:
+            return
+        from ultralytics import YOLO
+        # model_path may also be an export from InferenceBackends.py, a .onnx file or an _openvino_model directory
+        self.model = YOLO(model_path, task='segment')
+        names = self.model.names
+        if names is None:
+            # Exported models only expose their class names once the predictor is set up
+            self.model.predict(np.zeros((480, 640, 3), dtype=np.uint8), verbose=False)
+            names = self.model.predictor.model.names
+        # Keep only cow detections, or everything for a model without a 'cow' class
+        self.classes = [class_id for class_id, name in names.items() if name == 'cow'] or None
 
 
     def preprocess_image(self, image):
-        converted_image = cv.cvtColor(image, cv.COLOR_BGR2RGB)
-        resized_image = cv.resize(converted_image, dsize=(640, 480), interpolation=cv.INTER_CUBIC)
+        # Images are BGR throughout the pipeline, which is also what YOLO takes
+        if image.shape[:2] == (480, 640):
+            # Already at the model input size (e.g. from DistortionCorrection.undistort_resized)
+            return image
+        resized_image = cv.resize(image, dsize=(640, 480), interpolation=cv.INTER_CUBIC)
         return resized_image
 
-    def segment(self, image):
-        return self.model.predict(source=image, conf=0.25, save=True)
+    """
+        segment runs YOLO on the image and returns a compact SegmentationResult.
+        save=True additionally writes the annotated image under runs/ like before
+    """
+    def segment(self, image, save=False):
+        results = self.model.predict(source=image, conf=self.conf, classes=self.classes, save=save, verbose=False)
+        with tracer.stage('mask_extraction'):
+            return SegmentationResult.from_ultralytics(results, image.shape[:2])
+
+    """
+        segment_batch runs YOLO on several images in one forward pass, one result per image
+    """
+    def segment_batch(self, images):
+        results = self.model.predict(source=list(images), conf=self.conf, classes=self.classes, verbose=False)
+        with tracer.stage('mask_extraction'):
+            return [SegmentationResult.from_ultralytics([result], image.shape[:2])
+                    for result, image in zip(results, images)]
+
+    """
+        get_detection pulls the first detection out of the result
+        Outputs:
+        - box as (x1, y1, x2, y2), confidence, mask as a boolean array
+    """
+    def get_detection(self, results):
+        return results.boxes[0], float(results.confidences[0]), results.full_mask(0)
 
     def get_binary_mask(self, results):
-        return results[0].masks.data.cpu().numpy()[0]
+        return results.full_mask(0).astype(np.float32)
     
     def get_filtered(self, image, results):
-        image_copy = np.copy(image)
-        mask = results[0].masks.data.cpu().numpy()[0]
-        image_copy[np.where(mask == 0)] = 0
-        return image_copy
+        return results.filtered(image, 0)
 
     def get_bounding(self, image, results):
         image_copy = np.copy(image)
-        cv.rectangle(image_copy, (int(results[0].boxes.xyxy[0][0].item()), int(results[0].boxes.xyxy[0][1].item())), (int(results[0].boxes.xyxy[0][2].item()), int(results[0].boxes.xyxy[0][3].item())), (240,0,255), 2)
-        cv.putText(image_copy, 'cow ' + str(round(results[0].boxes.conf[0].item(), 2)), (int(results[0].boxes.xyxy[0][0].item()), int(results[0].boxes.xyxy[0][1].item()) - 7), cv.FONT_HERSHEY_SIMPLEX, 1, (240,0,255), 2)
+        x1, y1, x2, y2 = (int(v) for v in results.boxes[0])
+        cv.rectangle(image_copy, (x1, y1), (x2, y2), (240,0,255), 2)
+        cv.putText(image_copy, 'cow ' + str(round(float(results.confidences[0]), 2)), (x1, y1 - 7), cv.FONT_HERSHEY_SIMPLEX, 1, (240,0,255), 2)
         return image_copy
 
     def display_image(self, image):
+        import matplotlib.pyplot as plt
         plt.imshow(image.astype('uint8'))
         plt.axis('off')
         plt.show()
@@ -0,0 +1,283 @@
+import atexit
+import itertools
+import queue
+import sys
+import threading
+from concurrent.futures import Future
+from contextlib import contextmanager
+from multiprocessing import get_context, shared_memory
+import numpy as np
+from SegmentationModel import SegmentationModel, SegmentationResult
+from CowWeightPredictor import CowWeightPredictor
+
+"""
+Usage:
+    workers = StageWorkers(partial(SegmentationModel, 'yolov8m-seg.pt'),
+                           partial(CowWeightPredictor, 'weights.03.hdf5'))
+    workers.start()
+    pipeline = CowPipeline(WorkerSegmentationModel(workers), distortion_correction,
+                           WorkerWeightPredictor(workers))
+    ...
+    workers.close()
+
+YOLO and the weight predictor each get their own process, so Torch, TensorFlow and the Qt
+event loop no longer share a GIL or fight over one set of thread pools. Images, predictor
+batches and masks travel through SharedRing slots; only small metadata (slot numbers, shapes,
+boxes) is pickled through the queues. The model factories must be picklable, e.g. a partial of
+the model class, because the workers are spawned rather than forked. A ThreadBudget is applied
+in each worker before its model loads.
+
+While one image is in the predictor process the next one can already be segmented, e.g. with
+the separate segment and predict threads of BatchPipeline.
+
+Spawned children normally re-import the parent's __main__ script first, for main.py that is
+PySide6 and the whole GUI. The worker entry points live in this module, so the workers are
+started without it and only import what the models need.
+"""
+
+
+class SharedRing:
+    """
+        Fixed size slots in one shared memory block. A producer takes a free slot number from
+        a queue, so it blocks while every slot is in use, and the slot is handed back once all
+        of its consumers released it
+    """
+    def __init__(self, context, slots, slot_bytes):
+        self.slots = slots
+        self.slot_bytes = slot_bytes
+        self.shm = shared_memory.SharedMemory(create=True, size=slots * slot_bytes)
+        self.name = self.shm.name
+        self.owner = True
+        self.free = context.Queue()
+        for slot in range(slots):
+            self.free.put(slot)
+        self.refcounts = context.Array('i', slots)
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        del state['shm']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.owner = False
+        # Only the creating process unlinks the block, the workers merely attach to it
+        self.shm = shared_memory.SharedMemory(name=self.name)
+
+    def write(self, array, consumers=1, timeout=None):
+        array = np.asarray(array)
+        if array.nbytes > self.slot_bytes:
+            raise ValueError(f"{array.nbytes} bytes do not fit a {self.slot_bytes} byte slot")
+        try:
+            slot = self.free.get(timeout=timeout)
+        except queue.Empty:
+            raise TimeoutError(f"No free shared memory slot after {timeout}s")
+        self.refcounts[slot] = consumers
+        np.copyto(self.view(slot, array.shape, array.dtype.str), array)
+        return slot, array.shape, array.dtype.str
+
+    def view(self, slot, shape, dtype):
+        return np.ndarray(shape, dtype=dtype, buffer=self.shm.buf, offset=slot * self.slot_bytes)
+
+    def release(self, slot):
+        with self.refcounts.get_lock():
+            self.refcounts[slot] -= 1
+            if self.refcounts[slot] > 0:
+                return
+        self.free.put(slot)
+
+    def close(self):
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+
+def segmentation_worker(model_factory, thread_budget, frames, masks, jobs, results):
+    try:
+        if thread_budget is not None:
+            thread_budget.apply_opencv()
+            thread_budget.apply_segmentation()
+        model = model_factory()
+    except Exception as e:
+        results.put(('failed', 'segment', str(e)))
+        return
+    results.put(('ready', 'segment', None))
+    while True:
+        job = jobs.get()
+        if job is None:
+            break
+        job_id, frame_ref = job
+        try:
+            packed = model.segment(frames.view(*frame_ref)).pack()
+            # The mask bits go back through shared memory, the rest is a few small arrays
+            mask_ref = masks.write(packed.pop('mask_bits'))
+            results.put(('result', job_id, (packed, mask_ref)))
+        except Exception as e:
+            results.put(('error', job_id, str(e)))
+        finally:
+            frames.release(frame_ref[0])
+
+
+def prediction_worker(model_factory, thread_budget, batches, jobs, results):
+    try:
+        if thread_budget is not None:
+            thread_budget.apply_prediction()
+        predictor = model_factory()
+    except Exception as e:
+        results.put(('failed', 'predict', str(e)))
+        return
+    results.put(('ready', 'predict', None))
+    while True:
+        job = jobs.get()
+        if job is None:
+            break
+        job_id, batch_ref = job
+        try:
+            results.put(('result', job_id, predictor.predict_batch(batches.view(*batch_ref))))
+        except Exception as e:
+            results.put(('error', job_id, str(e)))
+        finally:
+            batches.release(batch_ref[0])
+
+
+@contextmanager
+def without_main_module():
+    # multiprocessing re-imports __main__ in spawned children through its __spec__ or __file__
+    main_module = sys.modules['__main__']
+    saved = {name: main_module.__dict__[name] for name in ('__spec__', '__file__') if name in main_module.__dict__}
+    main_module.__spec__ = None
+    main_module.__dict__.pop('__file__', None)
+    try:
+        yield
+    finally:
+        main_module.__dict__.update(saved)
+
+
+class StageWorkers:
+    def __init__(self, segmentation_factory, predictor_factory, slots=4, frame_shape=(480, 640, 3),
+                 batch_size=16, max_instances=32, timeout=30.0, thread_budget=None):
+        context = get_context('spawn')
+        self.timeout = timeout
+        self.batch_size = batch_size
+        frame_bytes = int(np.prod(frame_shape))
+        self.frames = SharedRing(context, slots, frame_bytes)
+        self.batches = SharedRing(context, slots, batch_size * 224 * 224 * 3)
+        # Bit-packed masks of up to max_instances animals covering the whole frame
+        self.masks = SharedRing(context, slots, (frame_shape[0] * frame_shape[1] * max_instances + 7) // 8)
+        self.segment_jobs = context.Queue()
+        self.predict_jobs = context.Queue()
+        self.results = context.Queue()
+        self.processes = [
+            context.Process(target=segmentation_worker, name='livelens-segment', daemon=True,
+                            args=(segmentation_factory, thread_budget, self.frames, self.masks, self.segment_jobs, self.results)),
+            context.Process(target=prediction_worker, name='livelens-predict', daemon=True,
+                            args=(predictor_factory, thread_budget, self.batches, self.predict_jobs, self.results)),
+        ]
+        self.ready = {'segment': Future(), 'predict': Future()}
+        self.pending = {} # Job id to (kind, Future)
+        self.lock = threading.Lock()
+        self.ids = itertools.count()
+        self.closed = False
+        self.collector = threading.Thread(target=self.collect_loop, name='stage-results', daemon=True)
+
+    def start(self):
+        with without_main_module():
+            for process in self.processes:
+                process.start()
+        self.collector.start()
+        atexit.register(self.close)
+
+    def submit(self, kind, ring, jobs, array):
+        if self.closed:
+            raise RuntimeError("Stage workers are shut down")
+        ref = ring.write(array, timeout=self.timeout)
+        job_id = next(self.ids)
+        future = Future()
+        with self.lock:
+            self.pending[job_id] = (kind, future)
+        jobs.put((job_id, ref))
+        return future
+
+    def segment(self, image):
+        return self.submit('segment', self.frames, self.segment_jobs, np.ascontiguousarray(image)).result(self.timeout)
+
+    def forward(self, batch):
+        return self.submit('predict', self.batches, self.predict_jobs, np.ascontiguousarray(batch)).result(self.timeout)
+
+    def collect_loop(self):
+        while True:
+            message = self.results.get()
+            if message is None:
+                break
+            kind, job_id, payload = message
+            if kind in ('ready', 'failed'):
+                future = self.ready[job_id]
+                if kind == 'ready':
+                    future.set_result(True)
+                else:
+                    future.set_exception(RuntimeError(f"Failed to load the {job_id} model: {payload}"))
+                continue
+            with self.lock:
+                job_kind, future = self.pending.pop(job_id, (None, None))
+            if kind == 'result' and job_kind == 'segment':
+                packed, mask_ref = payload
+                # Copy the bits out so the mask slot can be reused straight away
+                packed['mask_bits'] = self.masks.view(*mask_ref).copy()
+                self.masks.release(mask_ref[0])
+                payload = SegmentationResult.unpack(packed)
+            if future is None or not future.set_running_or_notify_cancel():
+                continue # Cancelled by cancel_pending
+            if kind == 'error':
+                future.set_exception(RuntimeError(payload))
+            else:
+                future.set_result(payload)
+
+    def cancel_pending(self):
+        # The workers still finish these jobs, their results are dropped
+        with self.lock:
+            futures = [future for _, future in self.pending.values()]
+        for future in futures:
+            future.cancel()
+
+    def close(self, timeout=5.0):
+        if self.closed:
+            return
+        self.closed = True
+        self.cancel_pending()
+        self.segment_jobs.put(None)
+        self.predict_jobs.put(None)
+        for process in self.processes:
+            if process.pid is None:
+                continue
+            process.join(timeout)
+            if process.is_alive():
+                process.terminate()
+                process.join(timeout)
+        self.results.put(None)
+        if self.collector.is_alive():
+            self.collector.join(timeout)
+        for ring in (self.frames, self.batches, self.masks):
+            ring.close()
+
+
+class WorkerSegmentationModel(SegmentationModel):
+    """
+        SegmentationModel whose segment runs in the segmentation worker process
+    """
+    def __init__(self, workers):
+        super().__init__()
+        self.workers = workers
+
+    def segment(self, image, save=False):
+        return self.workers.segment(image)
+
+
+class WorkerWeightPredictor(CowWeightPredictor):
+    """
+        CowWeightPredictor whose forward pass runs in the prediction worker process. Images are
+        resized into the batch buffer here and the batch is copied into shared memory once
+    """
+    def __init__(self, workers):
+        self.workers = workers
+        super().__init__(batch_size=workers.batch_size, backend='worker',
+                         forward=lambda batch: self.workers.forward(batch)[:, None])
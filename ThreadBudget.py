@@ -0,0 +1,265 @@
+import argparse
+import glob
+import json
+import os
+import subprocess
+import sys
+import time
+import numpy as np
+import cv2 as cv
+
+"""
+Usage:
+    # Once per machine: time a few allocations on Images/ and store the fastest
+    python ThreadBudget.py autotune --images "Images/*.jpg"
+
+    # Before the models load, main.py, BatchPipeline.py and the worker processes do
+    budget = load_thread_budget()        # livelens_threads.json, then LIVELENS_THREADS* overrides
+    budget.apply_opencv()
+    budget.apply_segmentation()          # right before SegmentationModel(...)
+    budget.apply_prediction()            # right before CowWeightPredictor(...)
+
+TensorFlow, Torch and OpenCV each size their thread pools to every core of the machine, so with
+all three loaded the stages oversubscribe the CPU and the tail latency jumps around. A
+ThreadBudget splits one core budget between them: intra-op and inter-op threads for the
+segmentation model (Torch) and the weight predictor (TensorFlow, or the threads option of the
+ONNX Runtime and OpenVINO backends), and the OpenCV pool used by undistort and resize.
+
+Settings come from the JSON file at LIVELENS_THREAD_CONFIG (default livelens_threads.json, as
+written by autotune) and the environment: LIVELENS_THREADS is the total budget,
+LIVELENS_THREADS_SEGMENT, LIVELENS_THREADS_SEGMENT_INTER, LIVELENS_THREADS_PREDICT,
+LIVELENS_THREADS_PREDICT_INTER and LIVELENS_THREADS_OPENCV set one pool each. The environment
+wins over the file, and pools set in neither are derived from the total.
+
+Thread pools can only be sized once per process, so autotune measures every candidate in a
+fresh subprocess.
+"""
+
+CONFIG_PATH = os.environ.get('LIVELENS_THREAD_CONFIG', 'livelens_threads.json')
+# Budget field to environment variable
+ENVIRONMENT = {
+    'total': 'LIVELENS_THREADS',
+    'segment_intra': 'LIVELENS_THREADS_SEGMENT',
+    'segment_inter': 'LIVELENS_THREADS_SEGMENT_INTER',
+    'predict_intra': 'LIVELENS_THREADS_PREDICT',
+    'predict_inter': 'LIVELENS_THREADS_PREDICT_INTER',
+    'opencv': 'LIVELENS_THREADS_OPENCV',
+}
+
+
+def configure_torch(intra, inter):
+    import torch
+    torch.set_num_threads(intra)
+    try:
+        torch.set_num_interop_threads(inter)
+    except RuntimeError as e:
+        # Only possible before Torch ran anything in parallel
+        print(f"Torch inter-op threads are already fixed, keeping them: {e}")
+
+
+def configure_tensorflow(intra, inter):
+    if 'tensorflow' not in sys.modules:
+        # Read by TensorFlow when it starts, so it is not imported just for this
+        os.environ['TF_NUM_INTRAOP_THREADS'] = str(intra)
+        os.environ['TF_NUM_INTEROP_THREADS'] = str(inter)
+        return
+    import tensorflow as tf
+    try:
+        tf.config.threading.set_intra_op_parallelism_threads(intra)
+        tf.config.threading.set_inter_op_parallelism_threads(inter)
+    except RuntimeError as e:
+        print(f"TensorFlow is already initialized, keeping its threads: {e}")
+
+
+class ThreadBudget:
+    """
+        Thread counts per pool. Pools left as None get a share of total: a quarter for OpenCV
+        and the rest split evenly between the two models, one inter-op thread each
+    """
+    def __init__(self, total=None, segment_intra=None, segment_inter=None, predict_intra=None,
+                 predict_inter=None, opencv=None):
+        self.total = max(1, int(total or os.cpu_count() or 1))
+        self.opencv = opencv or max(1, self.total // 4)
+        remaining = max(1, self.total - self.opencv)
+        self.segment_intra = segment_intra or max(1, (remaining + 1) // 2)
+        self.predict_intra = predict_intra or max(1, remaining // 2)
+        self.segment_inter = segment_inter or 1
+        self.predict_inter = predict_inter or 1
+
+    @classmethod
+    def from_dict(cls, values):
+        return cls(**{field: int(values[field]) for field in ENVIRONMENT if values.get(field)})
+
+    def to_dict(self):
+        return {field: getattr(self, field) for field in ENVIRONMENT}
+
+    def __repr__(self):
+        return (f"ThreadBudget(total={self.total}, segment={self.segment_intra}/{self.segment_inter}, "
+                f"predict={self.predict_intra}/{self.predict_inter}, opencv={self.opencv})")
+
+    def apply_opencv(self):
+        cv.setNumThreads(self.opencv)
+
+    def apply_segmentation(self):
+        configure_torch(self.segment_intra, self.segment_inter)
+
+    def apply_prediction(self):
+        # The ONNX Runtime and OpenVINO backends take predict_intra as their threads argument
+        configure_tensorflow(self.predict_intra, self.predict_inter)
+
+    def apply(self):
+        self.apply_opencv()
+        self.apply_segmentation()
+        self.apply_prediction()
+
+
+"""
+    load_thread_budget reads the budget from the config file and the environment, see the
+    module docstring. A missing or unreadable file only leaves the defaults
+"""
+def load_thread_budget(path=None):
+    path = path or CONFIG_PATH
+    values = {}
+    if os.path.exists(path):
+        try:
+            with open(path) as f:
+                values = json.load(f)
+        except (OSError, ValueError) as e:
+            print(f"Ignoring thread config {path}: {e}")
+    if os.environ.get(ENVIRONMENT['total']):
+        # A different total invalidates the pools tuned for the old one
+        values = {}
+    for field, variable in ENVIRONMENT.items():
+        if os.environ.get(variable):
+            values[field] = os.environ[variable]
+    return ThreadBudget.from_dict(values)
+
+
+def candidate_budgets(total):
+    # The default split, a few shifts of it and every pool at full size, without duplicates
+    candidates = [ThreadBudget(total), ThreadBudget(total, total, 1, total, 1, total)]
+    for opencv in (1, max(1, total // 4)):
+        remaining = max(1, total - opencv)
+        for segment_share in (0.25, 0.5, 0.75):
+            segment = max(1, round(remaining * segment_share))
+            candidates.append(ThreadBudget(total, segment, 1, max(1, remaining - segment), 1, opencv))
+    unique = {}
+    for budget in candidates:
+        unique.setdefault(tuple(budget.to_dict().values()), budget)
+    return list(unique.values())
+
+
+def load_models(models, predictor_backend, predictor_threads=None):
+    from SegmentationModel import SegmentationModel
+    from CowWeightPredictor import CowWeightPredictor
+    import Benchmark
+    use_real = models == 'real' or (models == 'auto' and os.path.exists(Benchmark.SEGMENTATION_WEIGHTS)
+                                    and os.path.exists(Benchmark.PREDICTOR_WEIGHTS))
+    if not use_real:
+        return Benchmark.stand_in_segmentation_model(), Benchmark.stand_in_weight_predictor(), 'stand-in'
+    return SegmentationModel(Benchmark.SEGMENTATION_WEIGHTS), \
+        CowWeightPredictor(Benchmark.PREDICTOR_WEIGHTS, backend=predictor_backend, threads=predictor_threads), 'real'
+
+
+"""
+    measure times the chain the Backend runs for one image (decode, undistort, segment, weigh)
+    under the given budget, in this process. budget None keeps the framework defaults
+"""
+def measure(budget, image_paths, repeat=3, warmup=2, models='auto', predictor_backend='keras'):
+    from DistortionCorrection import DistortionCorrection
+    from CowPipeline import CowPipeline
+    if budget is not None:
+        budget.apply()
+    segmentation_model, weight_predictor, models = load_models(
+        models, predictor_backend, None if budget is None else budget.predict_intra)
+    pipeline = CowPipeline(segmentation_model, DistortionCorrection((9, 6), (4032, 2268)), weight_predictor)
+
+    def run(path):
+        segmentation_input = pipeline.segmentation_input(pipeline.load(path))
+        processed_image, results = pipeline.segment(segmentation_input)
+        pipeline.predict_animals(processed_image, results)
+
+    for path in (image_paths * warmup)[:warmup]:
+        run(path)
+    latencies = []
+    for path in image_paths * repeat:
+        start = time.perf_counter()
+        run(path)
+        latencies.append(time.perf_counter() - start)
+    latencies = np.asarray(latencies) * 1000.0
+    return {'models': models, 'runs': len(latencies), 'mean_ms': float(latencies.mean()),
+            'p50_ms': float(np.percentile(latencies, 50)), 'p90_ms': float(np.percentile(latencies, 90))}
+
+
+def measure_in_subprocess(budget, args):
+    command = [sys.executable, os.path.abspath(__file__), 'measure', '--images', args.images,
+               '--limit', str(args.limit), '--repeat', str(args.repeat), '--models', args.models,
+               '--predictor-backend', args.predictor_backend,
+               '--budget', 'defaults' if budget is None else json.dumps(budget.to_dict())]
+    completed = subprocess.run(command, capture_output=True, text=True, timeout=args.timeout)
+    if completed.returncode != 0:
+        print(completed.stderr[-2000:])
+        raise RuntimeError(f"Measuring {budget} failed with exit code {completed.returncode}")
+    # The report is the last line, anything the frameworks printed comes before it
+    return json.loads(completed.stdout.strip().splitlines()[-1])
+
+
+"""
+    autotune measures the framework defaults and every candidate budget, each in its own
+    process, and writes the one with the lowest p90 latency to output together with the results
+"""
+def autotune(args):
+    total = args.total or int(os.environ.get(ENVIRONMENT['total']) or 0) or os.cpu_count() or 1
+    print(f"Tuning a budget of {total} threads")
+    baseline = measure_in_subprocess(None, args)
+    print(f"framework defaults  p50 {baseline['p50_ms']:8.1f} ms  p90 {baseline['p90_ms']:8.1f} ms")
+    results = []
+    for budget in candidate_budgets(total):
+        report = measure_in_subprocess(budget, args)
+        results.append(dict(budget.to_dict(), **report))
+        print(f"{budget}  p50 {report['p50_ms']:8.1f} ms  p90 {report['p90_ms']:8.1f} ms")
+    best = min(results, key=lambda result: (result['p90_ms'], result['mean_ms']))
+    config = {field: best[field] for field in ENVIRONMENT}
+    config['autotune'] = {
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'cpu_count': os.cpu_count(),
+        'models': baseline['models'],
+        'images': args.images,
+        'defaults': baseline,
+        'results': results,
+    }
+    with open(args.output, 'w') as f:
+        json.dump(config, f, indent=2)
+    print(f"Best {ThreadBudget.from_dict(best)}: p90 {best['p90_ms']:.1f} ms "
+          f"vs {baseline['p90_ms']:.1f} ms with the defaults, wrote {args.output}")
+    return config
+
+
+if __name__ == "__main__":
+    from InferenceBackends import PREDICTOR_BACKENDS
+
+    parser = argparse.ArgumentParser(description="Split the CPU between TensorFlow, Torch and OpenCV")
+    commands = parser.add_subparsers(dest='command', required=True)
+    for name in ('autotune', 'measure'):
+        command = commands.add_parser(name)
+        command.add_argument('--images', default='Images/*.jpg', help="Glob of sample images")
+        command.add_argument('--limit', type=int, default=8, help="Sample images to use")
+        command.add_argument('--repeat', type=int, default=3, help="Passes over the sample images")
+        command.add_argument('--models', choices=['auto', 'stand-in', 'real'], default='auto')
+        command.add_argument('--predictor-backend', choices=PREDICTOR_BACKENDS, default='keras')
+    commands.choices['autotune'].add_argument('--total', type=int, help="Core budget, default every core")
+    commands.choices['autotune'].add_argument('--output', default=CONFIG_PATH)
+    commands.choices['autotune'].add_argument('--timeout', type=float, default=600.0,
+                                              help="Seconds per candidate")
+    commands.choices['measure'].add_argument('--budget', default='defaults', help="Budget JSON or 'defaults'")
+    args = parser.parse_args()
+
+    image_paths = sorted(glob.glob(args.images))[:args.limit]
+    if not image_paths:
+        sys.exit(f"No images match {args.images}")
+    if args.command == 'autotune':
+        autotune(args)
+    else:
+        budget = None if args.budget == 'defaults' else ThreadBudget.from_dict(json.loads(args.budget))
+        print(json.dumps(measure(budget, image_paths, args.repeat, models=args.models,
+                                 predictor_backend=args.predictor_backend)))
@@ -0,0 +1,167 @@
+import json
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+import numpy as np
+
+"""
+Usage:
+    from Tracing import tracer
+
+    with tracer.stage('segment', image=processed_image) as span:
+        results = model.segment(processed_image)
+        span.add(mask=mask)
+
+    tracer.summary()  # {'segment': {'count': 1, 'p50_ms': ..., 'cpu_p50_ms': ..., ...}}
+
+Every stage records wall time, process CPU time (which includes the TensorFlow / Torch / OpenCV
+worker threads), the shapes and sizes of the arrays it was given and the change in resident
+memory. The last `window` records per stage are kept for the rolling statistics of each. Set LIVELENS_TRACE_LOG
+to a file path to also append every record to it as JSON lines.
+"""
+
+try:
+    import psutil
+    _process = psutil.Process()
+except ImportError:
+    _process = None
+
+
+def current_rss():
+    # Resident set size in bytes, None when neither psutil nor /proc is available
+    if _process is not None:
+        return _process.memory_info().rss
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+def describe_array(array):
+    array = np.asarray(array)
+    return {'shape': list(array.shape), 'dtype': str(array.dtype), 'bytes': int(array.nbytes)}
+
+
+class Span:
+    def __init__(self, name, arrays):
+        self.name = name
+        self.arrays = {key: describe_array(value) for key, value in arrays.items() if value is not None}
+
+    def add(self, **arrays):
+        for key, value in arrays.items():
+            if value is not None:
+                self.arrays[key] = describe_array(value)
+
+
+class Tracer:
+    def __init__(self, log_path=None, window=200):
+        self.window = window
+        self.histograms = {} # Stage name to a deque of the latest (wall ms, cpu ms, array MB, rss delta MB)
+        self.last_records = {}
+        self.listeners = []
+        self.enabled = True # When False stages run without being timed or recorded, see paused
+        self._lock = threading.Lock()
+        self._log_file = open(log_path, 'a') if log_path else None
+
+    def add_listener(self, listener):
+        self.listeners.append(listener)
+
+    def remove_listener(self, listener):
+        if listener in self.listeners:
+            self.listeners.remove(listener)
+
+    @contextmanager
+    def paused(self):
+        # Turns the tracer off for everything that runs inside, for timing code without its overhead
+        enabled, self.enabled = self.enabled, False
+        try:
+            yield
+        finally:
+            self.enabled = enabled
+
+    @contextmanager
+    def stage(self, name, **arrays):
+        if not self.enabled:
+            yield Span(name, {})
+            return
+        span = Span(name, arrays)
+        rss_start = current_rss()
+        cpu_start = time.process_time()
+        wall_start = time.perf_counter()
+        try:
+            yield span
+        finally:
+            wall_ms = (time.perf_counter() - wall_start) * 1000.0
+            cpu_ms = (time.process_time() - cpu_start) * 1000.0
+            rss_end = current_rss()
+            record = {
+                'time': time.time(),
+                'stage': name,
+                'thread': threading.current_thread().name,
+                'wall_ms': round(wall_ms, 3),
+                'cpu_ms': round(cpu_ms, 3),
+                'rss_delta_mb': None if rss_start is None or rss_end is None
+                                else round((rss_end - rss_start) / 1024**2, 3),
+                'arrays': span.arrays,
+            }
+            self.record(record)
+
+    def record(self, record):
+        with self._lock:
+            histogram = self.histograms.get(record['stage'])
+            if histogram is None:
+                histogram = self.histograms[record['stage']] = deque(maxlen=self.window)
+            array_mb = sum(array['bytes'] for array in record['arrays'].values()) / 1024**2
+            # A missing RSS reading is kept as NaN so it drops out of the statistics
+            rss_delta_mb = np.nan if record['rss_delta_mb'] is None else record['rss_delta_mb']
+            histogram.append((record['wall_ms'], record['cpu_ms'], array_mb, rss_delta_mb))
+            self.last_records[record['stage']] = record
+            if self._log_file is not None:
+                self._log_file.write(json.dumps(record) + '\n')
+                self._log_file.flush()
+        for listener in list(self.listeners):
+            try:
+                listener(record)
+            except Exception as e:
+                print(f"Trace listener failed: {e}")
+
+    """
+        summary has the rolling statistics of every stage: wall and CPU time percentiles, the
+        mean and largest array input in MB, and the mean and largest RSS change in MB (None
+        when RSS cannot be read)
+    """
+    def summary(self):
+        with self._lock:
+            histograms = {name: np.array(values, dtype=np.float64) for name, values in self.histograms.items()}
+            last_records = dict(self.last_records)
+        summary = {}
+        for name, values in histograms.items():
+            wall, cpu, array_mb, rss_delta_mb = values.T
+            rss_delta_mb = rss_delta_mb[~np.isnan(rss_delta_mb)]
+            summary[name] = {
+                'count': int(len(values)),
+                'last_ms': last_records[name]['wall_ms'],
+                'cpu_ms': last_records[name]['cpu_ms'],
+                'p50_ms': round(float(np.percentile(wall, 50)), 2),
+                'p90_ms': round(float(np.percentile(wall, 90)), 2),
+                'p99_ms': round(float(np.percentile(wall, 99)), 2),
+                'cpu_p50_ms': round(float(np.percentile(cpu, 50)), 2),
+                'cpu_p99_ms': round(float(np.percentile(cpu, 99)), 2),
+                'array_mean_mb': round(float(array_mb.mean()), 3),
+                'array_max_mb': round(float(array_mb.max()), 3),
+                'rss_delta_mean_mb': round(float(rss_delta_mb.mean()), 3) if len(rss_delta_mb) else None,
+                'rss_delta_max_mb': round(float(rss_delta_mb.max()), 3) if len(rss_delta_mb) else None,
+            }
+        return summary
+
+    def reset(self):
+        with self._lock:
+            self.histograms = {}
+            self.last_records = {}
+
+
+# Shared tracer used by the pipeline modules
+tracer = Tracer(os.environ.get('LIVELENS_TRACE_LOG'))
@@ -0,0 +1,231 @@
+import os
+import threading
+import time
+import cv2 as cv
+from Tracing import tracer
+
+"""
+Usage:
+    stream = VideoStream(pipeline, '0')               # capture device 0
+    stream = VideoStream(pipeline, 'chute.mp4', on_result=print)
+    stream.start()
+    index, frame = stream.latest_frame()              # newest 640x480 model input, for display
+    update = stream.latest_update()                   # newest detections and smoothed weights
+    stream.stop()                                     # returns at once, stream.join() waits
+
+Frames are read and undistorted to the model input on one thread and run through the models on
+another, the display takes the same undistorted frame. Only the newest frame is kept, so when
+inference is slower than the camera the frames in between are dropped instead of queueing up.
+YOLO runs again only every detect_every processed frames, when the scene moved by more than
+motion_threshold (mean absolute difference of a small grayscale thumbnail) or while nothing is
+detected; in between the last masks are reused and only the weight predictor runs. Weights are
+smoothed with an exponential moving average per animal, matching each animal to the one of the
+previous update whose box overlaps it most.
+"""
+
+
+def box_iou(a, b):
+    # Intersection over union of two (x1, y1, x2, y2) boxes
+    width = min(a[2], b[2]) - max(a[0], b[0])
+    height = min(a[3], b[3]) - max(a[1], b[1])
+    if width <= 0 or height <= 0:
+        return 0.0
+    intersection = width * height
+    union = (a[2] - a[0]) * (a[3] - a[1]) + (b[2] - b[0]) * (b[3] - b[1]) - intersection
+    return intersection / union if union > 0 else 0.0
+
+
+class LatestFrame:
+    """
+        Single slot holding the newest frame, put overwrites whatever was not taken yet
+    """
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.index = 0
+        self.frame = None
+
+    def put(self, frame):
+        with self.condition:
+            self.index += 1
+            self.frame = frame
+            self.condition.notify_all()
+
+    def get(self):
+        with self.condition:
+            return self.index, self.frame
+
+    def wait_newer(self, index, timeout=None):
+        # Blocks until a frame newer than index arrives, returns (index, None) on timeout
+        with self.condition:
+            if not self.condition.wait_for(lambda: self.index > index, timeout):
+                return index, None
+            return self.index, self.frame
+
+
+class VideoStream:
+    def __init__(self, pipeline, source, detect_every=10, motion_threshold=6.0, smoothing=0.3,
+                 match_iou=0.3, on_result=None, on_finished=None, wait_for_models=None):
+        self.pipeline = pipeline
+        # Digits select a capture device, anything else is a video file or stream URL
+        self.source = int(source) if str(source).isdigit() else source
+        self.detect_every = detect_every
+        self.motion_threshold = motion_threshold
+        self.smoothing = smoothing
+        self.match_iou = match_iou # Least box overlap for an animal to continue an average
+        self.on_result = on_result
+        self.on_finished = on_finished
+        self.wait_for_models = wait_for_models
+        self.frames = LatestFrame()
+        self.stop_event = threading.Event()
+        self.threads = []
+        self.capture = None
+        self.update = None # Newest result of the inference thread
+        self.update_lock = threading.Lock()
+        self.stats = {'captured': 0, 'processed': 0, 'dropped': 0, 'detections': 0, 'inference_fps': 0.0}
+
+    def start(self):
+        self.capture = cv.VideoCapture(self.source)
+        if not self.capture.isOpened():
+            self.capture.release()
+            raise IOError(f"Failed to open video source {self.source}")
+        self.threads = [threading.Thread(target=self.capture_loop, name='stream-capture', daemon=True),
+                        threading.Thread(target=self.inference_loop, name='stream-inference', daemon=True)]
+        for thread in self.threads:
+            thread.start()
+
+    """
+        stop asks both threads to finish and returns without waiting, so it is safe on the UI
+        thread. The capture thread releases the capture itself once its last read returns
+    """
+    def stop(self):
+        self.stop_event.set()
+
+    def join(self, timeout=None):
+        for thread in self.threads:
+            if thread is not threading.current_thread():
+                thread.join(timeout)
+
+    def latest_frame(self):
+        return self.frames.get()
+
+    def latest_update(self):
+        with self.update_lock:
+            return self.update
+
+    def capture_loop(self):
+        try:
+            self.read_frames()
+        except Exception as e:
+            print(f"Stream capture failed: {e}")
+            self.stop_event.set()
+            if self.on_finished is not None:
+                self.on_finished()
+        finally:
+            # Only this thread reads, so the capture is never released in the middle of a read
+            self.capture.release()
+
+    def read_frames(self):
+        # Video files are paced to their frame rate, devices block in read() on their own
+        is_file = isinstance(self.source, str) and os.path.exists(self.source)
+        fps = self.capture.get(cv.CAP_PROP_FPS) if is_file else 0
+        interval = 1.0 / fps if fps and fps > 0 else 0
+        next_time = time.perf_counter()
+        while not self.stop_event.is_set():
+            ok, frame = self.capture.read()
+            if not ok:
+                print(f"Video source {self.source} ended")
+                self.stop_event.set()
+                if self.on_finished is not None:
+                    self.on_finished()
+                return
+            # Undistorted here so neither the inference thread nor the UI thread has to
+            self.frames.put(self.pipeline.frame_input(frame))
+            self.stats['captured'] += 1
+            if interval:
+                next_time += interval
+                delay = next_time - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+                else:
+                    next_time = time.perf_counter()
+
+    """
+        needs_detection decides whether the frame gets a fresh YOLO pass or reuses the last masks
+    """
+    def needs_detection(self, result, frames_since_detection, thumbnail, reference):
+        if result is None or len(result) == 0:
+            return True
+        if frames_since_detection >= self.detect_every:
+            return True
+        motion = float(cv.absdiff(thumbnail, reference).mean())
+        return motion > self.motion_threshold
+
+    """
+        smooth averages the weight of each animal with the animal of the previous update whose box
+        overlaps it most, at least match_iou. Animals without a match start a new average, so
+        detection order and animals entering or leaving do not mix weights up
+        Outputs:
+        - (box, smoothed weight) of every animal, previous for the next call
+    """
+    def smooth(self, previous, animals):
+        tracks = []
+        matched = set()
+        for animal in animals:
+            best, best_iou = None, self.match_iou
+            for j, (box, _) in enumerate(previous):
+                iou = box_iou(animal['box'], box)
+                if j not in matched and iou >= best_iou:
+                    best, best_iou = j, iou
+            if best is not None:
+                matched.add(best)
+                smoothed = previous[best][1]
+                animal['weight'] = float(smoothed + self.smoothing * (animal['weight'] - smoothed))
+            tracks.append((animal['box'], animal['weight']))
+        return tracks
+
+    def inference_loop(self):
+        if self.wait_for_models is not None:
+            self.wait_for_models()
+        index = 0
+        result = None
+        reference = None
+        tracks = [] # (box, smoothed weight) of the previous update
+        frames_since_detection = 0
+        last_time = None
+        while not self.stop_event.is_set():
+            newest, processed_image = self.frames.wait_newer(index, timeout=0.5)
+            if processed_image is None:
+                continue
+            self.stats['dropped'] += newest - index - 1
+            index = newest
+            try:
+                thumbnail = cv.cvtColor(cv.resize(processed_image, (80, 60), interpolation=cv.INTER_AREA),
+                                        cv.COLOR_BGR2GRAY)
+                detected = self.needs_detection(result, frames_since_detection, thumbnail, reference)
+                if detected:
+                    with tracer.stage('segment', image=processed_image), self.pipeline.segmentation_lock:
+                        result = self.pipeline.SegmentationModel.segment(processed_image)
+                    reference = thumbnail
+                    frames_since_detection = 0
+                    self.stats['detections'] += 1
+                else:
+                    frames_since_detection += 1
+                animals = self.pipeline.predict_animals(processed_image, result)
+                tracks = self.smooth(tracks, animals)
+            except Exception as e:
+                print(f"Stream inference failed: {e}")
+                continue
+            now = time.perf_counter()
+            if last_time is not None:
+                fps = 1.0 / max(now - last_time, 1e-6)
+                self.stats['inference_fps'] += 0.2 * (fps - self.stats['inference_fps'])
+            last_time = now
+            self.stats['processed'] += 1
+            update = {'index': index, 'result': result, 'animals': animals, 'detected': detected}
+            if self.stop_event.is_set():
+                # Stopped while this frame was in the models, nobody wants the result any more
+                break
+            with self.update_lock:
+                self.update = update
+            if self.on_result is not None:
+                self.on_result(update)
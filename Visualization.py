@@ -0,0 +1,63 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import cv2 as cv
+
+"""
+In-memory rendering of the segmentation results. Everything here returns BGR numpy arrays, the
+color order of the whole pipeline, so the Backend can wrap them as QImages without going through
+matplotlib and a PNG on disk.
+"""
+
+BOX_COLOR = (240, 0, 255)
+
+
+def draw_bounding_boxes(image, boxes, confidences, labels=None):
+    image_copy = np.copy(image)
+    for index, (box, confidence) in enumerate(zip(boxes, confidences)):
+        label = labels[index] if labels is not None else f"cow {index + 1}"
+        x1, y1, x2, y2 = (int(v) for v in box)
+        cv.rectangle(image_copy, (x1, y1), (x2, y2), BOX_COLOR, 2)
+        cv.putText(image_copy, label + ' ' + str(round(float(confidence), 2)), (x1, y1 - 7),
+                   cv.FONT_HERSHEY_SIMPLEX, 1, BOX_COLOR, 2)
+    return image_copy
+
+
+"""
+    colorize_mask maps a 0..1 mask through viridis, the colormap plt.imshow used before.
+    An integer label mask is normalized by its highest label so every animal gets its own color
+    Outputs:
+    - a BGR uint8 image the size of the mask
+"""
+def colorize_mask(mask):
+    mask = np.asarray(mask, dtype=np.float32)
+    if mask.max() > 1:
+        mask = mask / mask.max()
+    mask_u8 = (mask * 255).clip(0, 255).astype(np.uint8)
+    return cv.applyColorMap(mask_u8, cv.COLORMAP_VIRIDIS)
+
+
+class DebugDumper:
+    """
+        Optional debug output, writes rendered images to output_dir on a background thread.
+        Does nothing when output_dir is None, e.g. LIVELENS_DEBUG_DUMP is not set
+    """
+    def __init__(self, output_dir=None):
+        self.output_dir = output_dir
+        self.executor = ThreadPoolExecutor(max_workers=1) if output_dir else None
+
+    def dump(self, name, image):
+        if self.executor is None:
+            return
+        self.executor.submit(self._write, name, image)
+
+    def _write(self, name, image):
+        try:
+            os.makedirs(self.output_dir, exist_ok=True)
+            cv.imwrite(os.path.join(self.output_dir, f"{name}.png"), image)
+        except Exception as e:
+            print(f"Debug dump of {name} failed: {e}")
+
+    def shutdown(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
@@ -6,26 +6,49 @@ from pathlib import Path
 # Import the required libraries for QT and PySide6
 from PySide6.QtGui import QGuiApplication, QImage
 from PySide6.QtQml import QQmlApplicationEngine
-from PySide6.QtCore import QObject, Slot, Signal, Qt
+from PySide6.QtCore import QObject, Slot, Signal, Qt, QTimer
 from PySide6.QtQuick import QQuickImageProvider
 
 
 from typing import List, Dict
+from collections import OrderedDict
+import json
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 # Model imports
 import os
 import numpy as np
-from ultralytics import YOLO
 import cv2 as cv
-# Matplotlib for displaying images. switch to Agg backend
-import matplotlib
-matplotlib.use('Agg')
-import matplotlib.pyplot as plt
-import matplotlib.pyplot as plt
-from SegmentationModel import SegmentationModel
-from DistortionCorrection import DistortionCorrection
+from SegmentationModel import SegmentationModel, SegmentationResult
+from DistortionCorrection import DistortionCorrection, load_calibration_file
 from CowWeightPredictor import CowWeightPredictor
+from CowPipeline import CowPipeline, parse_image_name
+from ArtifactCache import ArtifactCache, stage_dependencies
+from Tracing import tracer
+from Visualization import DebugDumper, colorize_mask, draw_bounding_boxes
+from VideoStream import VideoStream
+from InferenceServer import InferenceClient, RemoteSegmentationModel, RemoteWeightPredictor
+from StageWorkers import StageWorkers, WorkerSegmentationModel, WorkerWeightPredictor
+from ThreadBudget import load_thread_budget
+from GeometricWeightEstimator import GeometricWeightEstimator
 from PySide6.QtCore import Qt
 
+# Model files, override them to run exported models (see InferenceBackends.py)
+SEGMENTATION_MODEL = os.environ.get('LIVELENS_SEGMENTATION_MODEL', 'yolov8m-seg.pt')
+PREDICTOR_BACKEND = os.environ.get('LIVELENS_PREDICTOR_BACKEND', 'keras')
+PREDICTOR_MODEL = os.environ.get('LIVELENS_PREDICTOR_MODEL', 'weights.03.hdf5')
+# host:port or socket path of an InferenceServer to use instead of loading the models here
+INFERENCE_SERVER = os.environ.get('LIVELENS_INFERENCE_SERVER')
+# Fitted GeometricWeightEstimator, animals it weighs with confidence skip the ResNet
+WEIGHT_ESTIMATOR = os.environ.get('LIVELENS_WEIGHT_ESTIMATOR')
+# Set to 1 to run each model in its own worker process, see StageWorkers.py
+STAGE_WORKERS = os.environ.get('LIVELENS_STAGE_WORKERS') == '1'
+# Streaming mode: default capture device, display rate and how often YOLO runs on the stream
+STREAM_SOURCE = os.environ.get('LIVELENS_STREAM_SOURCE', '0')
+DISPLAY_FPS = int(os.environ.get('LIVELENS_DISPLAY_FPS', '30'))
+DETECT_EVERY = int(os.environ.get('LIVELENS_DETECT_EVERY', '10'))
+
 class State(Enum):
     INITIAL = auto()
     IMAGE_LOADED = auto()
@@ -38,27 +61,73 @@ class State(Enum):
     MEASURE_WEIGHT = auto()
     COMPARISON_DISPLAYED = auto()
     DONE = auto()
+    STREAMING = auto()
 
 class ImageProvider(QQuickImageProvider):
-    def __init__(self):
+    """
+        Holds the QImages shown by QML within a byte budget, evicting the least recently used
+        ones first. Scaled variants are cached per (id, requested size) so repeated requests
+        do not rescale the full resolution image
+    """
+    def __init__(self, max_bytes=256 * 1024**2):
        super().__init__(QQuickImageProvider.Image)
-       self.myImageMap = {} # Store the images here
+       self.max_bytes = max_bytes
+       self.myImageMap = OrderedDict() # Store the images here, least recently used first
+       self.scaledImages = OrderedDict() # (id, width, height) to the scaled image
+       self.current_bytes = 0
+       # QML may request images from its loader threads
+       self.lock = threading.Lock()
 
     def requestImage(self, id, size, requestedSize):
-        if id in self.myImageMap:
+        with self.lock:
+            if id not in self.myImageMap:
+                print(f"Image with id {id} not found")
+                return QImage()
+            self.myImageMap.move_to_end(id)
             image = self.myImageMap[id]
             if requestedSize.isValid():
-                image = image.scaled(requestedSize.width(), requestedSize.height(), Qt.KeepAspectRatio)
+                key = (id, requestedSize.width(), requestedSize.height())
+                if key in self.scaledImages:
+                    self.scaledImages.move_to_end(key)
+                    image = self.scaledImages[key]
+                else:
+                    image = image.scaled(requestedSize.width(), requestedSize.height(), Qt.KeepAspectRatio)
+                    self.scaledImages[key] = image
+                    self.current_bytes += image.sizeInBytes()
+                    self.evict(keep=id)
             size.setWidth(image.width())
             size.setHeight(image.height())
             return image
-        else:
-            print(f"Image with id {id} not found")
-            return QImage()
 
     def addImage(self, id, image):
-        # Add images to provider
-        self.myImageMap[id] = image
+        # Add images to provider, replacing an id drops its scaled variants
+        with self.lock:
+            self.remove(id)
+            self.myImageMap[id] = image
+            self.current_bytes += image.sizeInBytes()
+            self.evict(keep=id)
+
+    def discard(self, id):
+        # remove for callers that do not hold the lock
+        with self.lock:
+            self.remove(id)
+
+    def remove(self, id):
+        for key in [key for key in self.scaledImages if key[0] == id]:
+            self.current_bytes -= self.scaledImages.pop(key).sizeInBytes()
+        if id in self.myImageMap:
+            self.current_bytes -= self.myImageMap.pop(id).sizeInBytes()
+
+    def evict(self, keep):
+        # Scaled variants are cheap to rebuild, so they go before any full image
+        while self.current_bytes > self.max_bytes and self.scaledImages:
+            key, image = self.scaledImages.popitem(last=False)
+            self.current_bytes -= image.sizeInBytes()
+        for id in list(self.myImageMap):
+            if self.current_bytes <= self.max_bytes:
+                break
+            if id != keep:
+                self.remove(id)
 
 
 
@@ -70,138 +139,322 @@ class Backend(QObject):
     imageProcessed = Signal(str)
     # Signal for weight prediction
     weightPredicted = Signal(float)
+    # Signal with a JSON list of every animal's box, confidence and weight in lbs
+    animalsPredicted = Signal(str)
     # Signal for enum state
     stateChanged = Signal(str)
     # Signal for weight comparison
     weightComparison = Signal(float)
-    
+    # Signal while next_step waits on the background pipeline, empty string when done
+    progressChanged = Signal(str)
+    # Signal once both models have finished loading in the background
+    modelsReady = Signal()
+    # Per-stage latency summary as JSON, for the timing overlay
+    stageTimings = Signal(str)
+    # Emitted from the pipeline worker when a stage has stored its artifacts
+    stageCompleted = Signal(str)
+    # Emitted from the capture thread when a video file runs out of frames
+    streamEnded = Signal()
+
+    # Artifact each state needs from the background pipeline before it can be shown
+    STAGE_REQUIREMENTS = {
+        State.IMAGE_LOADED: 'undistorted',
+        State.DISTORTION_CORRECTION_1: 'undistorted',
+        State.DISTORTION_CORRECTION_2: 'undistorted',
+        State.DETECTION_1: 'segmented',
+        State.DETECTION_2: 'segmented',
+        State.SEGMENTATION_1: 'segmented',
+        State.SEGMENTATION_2: 'segmented',
+        State.MEASURE_WEIGHT: 'weight',
+    }
 
     def __init__(self):
         super(Backend, self).__init__()
         self.state = State.INITIAL
-        self.SegmentationModel = SegmentationModel("yolov8m-seg.pt")
+        self.SegmentationModel = None # Loaded in the background, see load_models
         self.DistortionCorrection = DistortionCorrection((9, 6), (4032, 2268))
-        self.CowWeightPredictor = CowWeightPredictor("weights.03.hdf5")
+        self.CowWeightPredictor = None
+        self.inference_client = None # Set when the models run in an InferenceServer
+        self.stage_workers = None # Set when the models run in worker processes
+        # Threads per framework, see ThreadBudget.py. OpenCV's pool is sized before first use
+        self.thread_budget = load_thread_budget()
+        self.thread_budget.apply_opencv()
+        print(f"Using {self.thread_budget}")
+        # Only a small regression, loaded right away
+        self.weight_estimator = GeometricWeightEstimator(WEIGHT_ESTIMATOR) if WEIGHT_ESTIMATOR else None
+        self.pipeline = CowPipeline(self.SegmentationModel, self.DistortionCorrection, self.CowWeightPredictor,
+                                    weight_estimator=self.weight_estimator)
+        self.load_models()
+        # One worker, the models are not safe to call from several threads at once
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.artifacts = {} # Stage results of the current image, filled by the worker
+        self.completed_stages = set() # Names of the stages whose artifacts are stored
+        self.artifacts_lock = threading.Lock()
+        self.cancel_event = threading.Event() # Set to stop the in-flight pipeline
+        self.pending_step = False # next_step is waiting on an artifact
+        self.stageCompleted.connect(self.on_stage_completed)
+        # Streaming mode, frames are published by the timer at display rate
+        self.stream = None
+        self.stream_frame_index = 0 # Index of the last frame shown
+        self.stream_image_ids = [] # Frame ids still in the image provider
+        self.display_timer = QTimer(self)
+        self.display_timer.setInterval(int(1000 / DISPLAY_FPS))
+        self.display_timer.timeout.connect(self.on_display_tick)
+        self.streamEnded.connect(self.stop_stream)
+        # Publish the rolling stage timings once a second, not on every traced stage
+        self.last_timings = None
+        self.timings_timer = QTimer(self)
+        self.timings_timer.setInterval(1000)
+        self.timings_timer.timeout.connect(self.publish_timings)
+        self.timings_timer.start()
+        # Per-stage results of images seen before, so re-opening an animal skips the models
+        self.cache = ArtifactCache(os.environ.get('LIVELENS_CACHE_DIR', '.livelens_cache'),
+                                   stage_dependencies=stage_dependencies(SEGMENTATION_MODEL, PREDICTOR_MODEL,
+                                                                        weight_estimator=WEIGHT_ESTIMATOR))
+        # Rendered images are only written to disk when LIVELENS_DEBUG_DUMP names a directory
+        self.debug_dumper = DebugDumper(os.environ.get('LIVELENS_DEBUG_DUMP'))
         self.input_image = None # For the original image
         self.processed_image = None # For intermediate steps
         self.cropped_image = None # For the distortion part 2
         self.results = None # For the segmentation results
         self.weight_predicted = None # For the predicted weight, in lbs?
         self.actual_weight = None # I know the weight is in kg and in the file name
-        
-    
 
+    """
+        load_models loads both models concurrently in the background so the window shows
+        immediately. modelsReady is emitted once both are loaded
+    """
+    def load_models(self):
+        self.model_loader = ThreadPoolExecutor(max_workers=2)
+        if INFERENCE_SERVER:
+            # Both models live in the inference server, only the connection is needed
+            self.segmentation_future = self.predictor_future = self.model_loader.submit(self.connect_inference_server)
+        elif STAGE_WORKERS:
+            self.start_stage_workers()
+        else:
+            self.segmentation_future = self.model_loader.submit(self.load_segmentation_model)
+            self.predictor_future = self.model_loader.submit(self.load_weight_predictor)
+        threading.Thread(target=self.wait_for_models, daemon=True).start()
+
+    def start_stage_workers(self):
+        # Each model loads in its own process, the futures resolve once it is ready
+        if PREDICTOR_BACKEND == 'keras':
+            predictor_factory = partial(CowWeightPredictor, PREDICTOR_MODEL,
+                                        model_cache_path=os.path.splitext(PREDICTOR_MODEL)[0] + ".keras")
+        else:
+            predictor_factory = partial(CowWeightPredictor, PREDICTOR_MODEL, backend=PREDICTOR_BACKEND,
+                                        threads=self.thread_budget.predict_intra)
+        self.stage_workers = StageWorkers(partial(SegmentationModel, SEGMENTATION_MODEL), predictor_factory,
+                                          thread_budget=self.thread_budget)
+        self.stage_workers.start()
+        self.segmentation_future = self.stage_workers.ready['segment']
+        self.predictor_future = self.stage_workers.ready['predict']
+        self.SegmentationModel = WorkerSegmentationModel(self.stage_workers)
+        self.CowWeightPredictor = WorkerWeightPredictor(self.stage_workers)
+        self.pipeline.SegmentationModel = self.SegmentationModel
+        self.pipeline.CowWeightPredictor = self.CowWeightPredictor
+
+    def connect_inference_server(self):
+        self.inference_client = InferenceClient(INFERENCE_SERVER)
+        print(f"Connected to inference server {INFERENCE_SERVER}: {self.inference_client.info()}")
+        self.SegmentationModel = RemoteSegmentationModel(self.inference_client)
+        self.CowWeightPredictor = RemoteWeightPredictor(self.inference_client)
+        self.pipeline.SegmentationModel = self.SegmentationModel
+        self.pipeline.CowWeightPredictor = self.CowWeightPredictor
+
+    def load_segmentation_model(self):
+        self.thread_budget.apply_segmentation()
+        self.SegmentationModel = SegmentationModel(SEGMENTATION_MODEL)
+        self.pipeline.SegmentationModel = self.SegmentationModel
+
+    def load_weight_predictor(self):
+        self.thread_budget.apply_prediction()
+        if PREDICTOR_BACKEND == 'keras':
+            # The assembled model is serialized next to the weights so restarts skip building it
+            self.CowWeightPredictor = CowWeightPredictor(PREDICTOR_MODEL,
+                                                         model_cache_path=os.path.splitext(PREDICTOR_MODEL)[0] + ".keras")
+        else:
+            self.CowWeightPredictor = CowWeightPredictor(PREDICTOR_MODEL, backend=PREDICTOR_BACKEND,
+                                                         threads=self.thread_budget.predict_intra)
+        self.pipeline.CowWeightPredictor = self.CowWeightPredictor
+
+    def wait_for_models(self):
+        try:
+            self.segmentation_future.result()
+            self.predictor_future.result()
+        except Exception as e:
+            print(f"Failed to load models: {e}")
+            self.progressChanged.emit(f"Failed to load models: {e}")
+            return
+        print("Models loaded")
+        self.modelsReady.emit()
+
+    def start_pipeline(self, image, image_path):
+        self.cancel_pipeline()
+        cancel_event = threading.Event()
+        self.cancel_event = cancel_event
+        self.executor.submit(self.run_pipeline, image, image_path, cancel_event)
+
+    def cancel_pipeline(self):
+        self.cancel_event.set()
+        if self.stage_workers is not None:
+            # Stop waiting on the worker processes, they drop the results of these jobs
+            self.stage_workers.cancel_pending()
+        self.pending_step = False
+        with self.artifacts_lock:
+            self.artifacts = {}
+            self.completed_stages = set()
+
+    def store_artifacts(self, cancel_event, stage, **artifacts):
+        with self.artifacts_lock:
+            # A cancelled run must not overwrite the artifacts of the next image
+            if cancel_event.is_set():
+                return False
+            self.artifacts.update(artifacts)
+            self.completed_stages.add(stage)
+        self.stageCompleted.emit(stage)
+        return True
+
+    """
+        run_pipeline runs every stage for one image on the worker thread, storing the
+        artifacts as each stage finishes. It stops between stages once cancel_event is set.
+        Stages already in the artifact cache for this image are read instead of recomputed
+    """
+    def run_pipeline(self, image, image_path, cancel_event):
+        try:
+            if cancel_event.is_set():
+                return
+            keys = self.cache.keys_for(image_path)
+            cached = self.cache.get(keys['undistorted'])
+            if cached is not None:
+                corrected_image = cached['corrected_image']
+                x, y, w, h = cached['crop_roi']
+                cropped_image = corrected_image[y:y+h, x:x+w]
+                segmentation_input = cached['segmentation_input']
+            else:
+                corrected_image, cropped_image = self.pipeline.undistort(image)
+                segmentation_input = self.pipeline.segmentation_input(image)
+                crop_roi = self.DistortionCorrection.get_undistort_maps(image.shape[1::-1])[2]
+                self.cache.put(keys['undistorted'], corrected_image=corrected_image,
+                               crop_roi=np.array(crop_roi), segmentation_input=segmentation_input)
+            if not self.store_artifacts(cancel_event, 'undistorted', corrected_image=corrected_image,
+                                        cropped_image=cropped_image):
+                return
+            cached = self.cache.get(keys['segmented'])
+            if cached is not None:
+                processed_image = cached['processed_image']
+                results = SegmentationResult.unpack(cached)
+            else:
+                # Undistortion does not need the models, wait for them only here
+                self.segmentation_future.result()
+                processed_image, results = self.pipeline.segment(segmentation_input)
+                self.cache.put(keys['segmented'], processed_image=processed_image, **results.pack())
+            if len(results) == 0:
+                raise ValueError("No cow detected in the image")
+            # Render the overlays in memory, BGR like everything else
+            with tracer.stage('render', image=processed_image):
+                bounding_box_image = draw_bounding_boxes(processed_image, results.boxes, results.confidences)
+                binary_mask = colorize_mask(results.label_mask())
+                filtered_image = results.filtered(processed_image)
+            if not self.store_artifacts(cancel_event, 'segmented', processed_image=processed_image, results=results,
+                                        bounding_box_image=bounding_box_image, binary_mask=binary_mask,
+                                        filtered_image=filtered_image):
+                return
+            cached = self.cache.get(keys['weight_animals'])
+            if cached is not None:
+                animals = [{'box': [float(v) for v in results.boxes[i]],
+                            'confidence': float(results.confidences[i]),
+                            'weight': float(weight)} for i, weight in enumerate(cached['animal_weights'])]
+            else:
+                self.predictor_future.result()
+                # Every animal in the frame goes through the predictor as one batch
+                animals = self.pipeline.predict_animals(processed_image, results)
+                self.cache.put(keys['weight_animals'],
+                               animal_weights=np.array([animal['weight'] for animal in animals]))
+            self.store_artifacts(cancel_event, 'weight', weight=animals[0]['weight'], animals=animals)
+        except Exception as e:
+            print(f"Pipeline failed: {e}")
+            self.store_artifacts(cancel_event, 'error', error=str(e))
+
+    def publish_timings(self):
+        # Skipped while nothing new was traced
+        timings = json.dumps(tracer.summary())
+        if timings != self.last_timings:
+            self.last_timings = timings
+            self.stageTimings.emit(timings)
+
+    @Slot(str)
+    def on_stage_completed(self, stage):
+        if self.pending_step:
+            required = self.STAGE_REQUIREMENTS.get(self.state)
+            if stage == required or stage == 'error':
+                self.pending_step = False
+                self.next_step()
 
     # This signal sends the QImage ids to the QML
     @Slot()
     def next_step(self):
+        if self.state == State.STREAMING:
+            # The stream publishes its own results, stop_stream ends it
+            return
+        required = self.STAGE_REQUIREMENTS.get(self.state)
+        if required is not None:
+            with self.artifacts_lock:
+                artifacts = dict(self.artifacts)
+                completed_stages = set(self.completed_stages)
+            if required not in completed_stages:
+                # Stages before the failed one are still shown, the error only stops this step
+                if 'error' in completed_stages:
+                    self.progressChanged.emit(f"Processing failed: {artifacts['error']}")
+                    return
+                # Publish once the worker has finished the stage
+                self.pending_step = True
+                self.progressChanged.emit(f"Processing ({required.replace('_', ' ')})...")
+                return
+            self.progressChanged.emit("")
         if self.state == State.INITIAL:            
             self.state = State.IMAGE_LOADED
         elif self.state == State.IMAGE_LOADED:
             print('State.IMAGE_LOADED')
-            # Apply distortion correction
-            isPrepared = self.prepare_calibration()
-            if isPrepared:
-                # Apply distortion correction to the image
-                self.processed_image, self.cropped_image = self.DistortionCorrection.distortion_correction(self.input_image)
-                self.processed_image = cv.cvtColor(self.processed_image, cv.COLOR_BGR2RGB)
-                self.cropped_image = cv.cvtColor(self.cropped_image, cv.COLOR_BGR2RGB)
-                print("Distortion correction applied")
-            else:
-                print("Failed to prepare calibration")
+            # Distortion correction already ran in the background
+            self.processed_image = artifacts['corrected_image']
+            self.cropped_image = artifacts['cropped_image']
+            print("Distortion correction applied")
             self.state = State.DISTORTION_CORRECTION_1
         elif self.state == State.DISTORTION_CORRECTION_1:
-            # Make RGB
-            self.processed_image = cv.cvtColor(self.processed_image, cv.COLOR_BGR2RGB)
             # Display processed image
-            qImg = self.convert_npy2qimg(self.processed_image)
-            # Add the image to the provider
-            image_provider.addImage("corrected_img", qImg)
-            # print image metadata from the map
-            print(f"Image metadata: {image_provider.myImageMap['corrected_img'].size()}")
-            # Emit the signal to indicate that the processed image is ready
-            self.imageProcessed.emit("corrected_img")
+            self.publish_image("corrected_img", self.processed_image)
             # Move to Distortion Correction Two
             self.state = State.DISTORTION_CORRECTION_2
         elif self.state == State.DISTORTION_CORRECTION_2:
-            self.cropped_image = cv.cvtColor(self.cropped_image, cv.COLOR_BGR2RGB)
             # Same as above but show cropped image
-            qImg = self.convert_npy2qimg(self.cropped_image)
-            # Add the image to the provider
-            image_provider.addImage("cropped_img", qImg)
-            # print image metadata from the map
-            print(f"Image metadata: {image_provider.myImageMap['cropped_img'].size()}")
-            # Emit the signal to indicate that the processed image is ready
-            self.imageProcessed.emit("cropped_img")
+            self.publish_image("cropped_img", self.cropped_image)
             self.state = State.DETECTION_1
         elif self.state == State.DETECTION_1:
-            # Preprocess the image
-            print("Preprocessing image...")
-            self.processed_image = self.SegmentationModel.preprocess_image(self.processed_image)
-            print("Preprocessing completed.")
-            # Now start Segmentation segment
-            print("Starting segmentation...")
-            self.results = self.SegmentationModel.segment(self.processed_image)
-            # Make a dir within runs/segment called binary_mask
-            os.makedirs('runs/segment/binary_mask', exist_ok=True)
-            # Make a dir within runs/segment called bounding_box
-            os.makedirs('runs/segment/bounding_box', exist_ok=True)
-            # Make a dir within runs/segment called filtered_image
-            os.makedirs('runs/segment/filtered_image', exist_ok=True)
-            # Display results
+            # Segmentation already ran in the background
+            self.processed_image = artifacts['processed_image']
+            self.results = artifacts['results']
             print("Segmentation completed.")        
             self.state = State.DETECTION_2
         elif self.state == State.DETECTION_2:
-            # Get the bounding box
-            bounding_box_image = self.SegmentationModel.get_bounding(self.processed_image, self.results)
-            # Convert color space from BGR to RGB
-            bounding_box_image_rgb = cv.cvtColor(bounding_box_image, cv.COLOR_BGR2RGB)
-            # Plot the bounding box
-            plt.imshow(bounding_box_image_rgb.astype('uint8'))
-            plt.axis('off')
-            plt.savefig('runs/segment/bounding_box/bounding_box.png')
-            # Save the bounding box to the image provider
-            qImg = QImage('runs/segment/bounding_box/bounding_box.png')
-            image_provider.addImage("bounding_box", qImg)
-            # Emit the signal to indicate that the processed image is ready
-            self.imageProcessed.emit("bounding_box")
+            # Show the bounding box rendered by the worker
+            self.publish_image("bounding_box", artifacts['bounding_box_image'])
             self.state = State.SEGMENTATION_1
         elif self.state == State.SEGMENTATION_1:
-            binary_mask = self.SegmentationModel.get_binary_mask(self.results)
-            # Plot the binary mask
-            plt.imshow(binary_mask)
-            plt.axis('off')
-            plt.savefig('runs/segment/binary_mask/binary_mask.png')
-            # Save the binary mask to the image provider
-            qImg = QImage('runs/segment/binary_mask/binary_mask.png')
-            image_provider.addImage("binary_mask", qImg) 
-            # Emit the signal to indicate that the processed image is ready
-            self.imageProcessed.emit("binary_mask")
+            # Show the colormapped binary mask
+            self.publish_image("binary_mask", artifacts['binary_mask'])
             self.state = State.SEGMENTATION_2
         elif self.state == State.SEGMENTATION_2:
-            # Get the filtered image
-            filtered_image = self.SegmentationModel.get_filtered(self.processed_image, self.results)
-            filtered_image_rgb = cv.cvtColor(filtered_image, cv.COLOR_BGR2RGB)
-            # Plot the filtered image
-            plt.imshow(filtered_image_rgb.astype('uint8'))
-            plt.axis('off')
-            plt.savefig('runs/segment/filtered_image/filtered_image.png')
-            # Save the filtered image to the image provider
-            qImg = QImage('runs/segment/filtered_image/filtered_image.png')
-            image_provider.addImage("filtered_image", qImg)
-            # Emit the signal to indicate that the processed image is ready
-            self.imageProcessed.emit("filtered_image")
+            # Show the image with everything outside the mask removed
+            self.publish_image("filtered_image", artifacts['filtered_image'])
             self.state = State.MEASURE_WEIGHT
         elif self.state == State.MEASURE_WEIGHT:
-            print("Making a prediction...")
             print("Actual weight: ", self.actual_weight, "kg") # This is the actual weight
             # Convert actual weight to lbs
             self.actual_weight = self.convertKgToLbs(self.actual_weight)
             print("Actual weight: ", self.actual_weight, "lbs") # This is the actual weight
-            # Make a prediction
-            self.weight_predicted = self.CowWeightPredictor.make_prediction(self.processed_image)
-            # Convert to float instead of numpy array
-            self.weight_predicted = self.weight_predicted[0][0]
+            # The prediction already ran in the background
+            self.weight_predicted = artifacts['weight']
             # Convert the weight to lbs
             self.weight_predicted = self.convertKgToLbs(self.weight_predicted)
             print("Predicted weight: ", self.weight_predicted, "lbs") # This is the predicted weight
@@ -209,6 +462,11 @@ class Backend(QObject):
             self.weight_predicted = round(self.weight_predicted, 2)
             # Emit the signal to indicate that the processed weight is ready
             self.weightPredicted.emit(self.weight_predicted)
+            # Every animal in the frame, in lbs, the first one is the weight above
+            animals = [{'box': animal['box'], 'confidence': round(animal['confidence'], 2),
+                        'weight': round(self.convertKgToLbs(animal['weight']), 2)}
+                       for animal in artifacts['animals']]
+            self.animalsPredicted.emit(json.dumps(animals))
             self.state = State.COMPARISON_DISPLAYED
         elif self.state == State.COMPARISON_DISPLAYED:
             # Calculate the difference
@@ -230,8 +488,98 @@ class Backend(QObject):
         # Emit the signal with the new state name
         self.stateChanged.emit(self.state.name)
         
+    """
+        start_stream runs a video file or capture device through the pipeline until stop_stream,
+        an empty source uses LIVELENS_STREAM_SOURCE (capture device 0 by default)
+    """
+    @Slot(str)
+    def start_stream(self, source: str):
+        if source.startswith("file:///"):
+            source = source[8:]
+        self.stop_stream()
+        # A stage already running on the executor finishes first: the stream waits on the
+        # pipeline's model locks, and the cancelled pipeline stops before its next stage
+        self.cancel_pipeline()
+        self.stream = VideoStream(self.pipeline, source or STREAM_SOURCE, detect_every=DETECT_EVERY,
+                                  on_result=self.on_stream_result, on_finished=self.streamEnded.emit,
+                                  wait_for_models=self.wait_for_stream_models)
+        try:
+            self.pipeline.prepare_calibration()
+            self.stream.start()
+        except Exception as e:
+            print(f"Error starting stream: {e}")
+            self.progressChanged.emit(f"Error starting stream: {e}")
+            self.stream = None
+            return
+        self.stream_frame_index = 0
+        self.display_timer.start()
+        self.state = State.STREAMING
+        self.stateChanged.emit(self.state.name)
+
+    @Slot()
+    def stop_stream(self):
+        if self.stream is None:
+            return
+        self.display_timer.stop()
+        self.stream.stop()
+        print(f"Stream stopped: {self.stream.stats}")
+        self.stream = None
+        self.progressChanged.emit("")
+        self.state = State.DONE
+        self.stateChanged.emit(self.state.name)
+
+    def wait_for_stream_models(self):
+        self.segmentation_future.result()
+        self.predictor_future.result()
+
+    def on_stream_result(self, update):
+        # Called on the stream inference thread, the signals are queued to the UI thread
+        animals = [{'box': animal['box'], 'confidence': round(animal['confidence'], 2),
+                    'weight': round(self.convertKgToLbs(animal['weight']), 2)}
+                   for animal in update['animals']]
+        if animals:
+            self.weightPredicted.emit(animals[0]['weight'])
+        self.animalsPredicted.emit(json.dumps(animals))
+        stats = self.stream.stats if self.stream is not None else None
+        if stats is not None:
+            self.progressChanged.emit(f"Streaming: {stats['inference_fps']:.1f} fps inference, "
+                                      f"{stats['dropped']} frames dropped")
+
+    """
+        on_display_tick publishes the newest frame with the newest detections drawn on it.
+        It runs on the UI thread at DISPLAY_FPS, independent of how fast inference keeps up.
+        The stream's capture thread already undistorted the frame, only the boxes are drawn here
+    """
+    @Slot()
+    def on_display_tick(self):
+        if self.stream is None:
+            return
+        index, frame = self.stream.latest_frame()
+        if frame is None or index == self.stream_frame_index:
+            return
+        self.stream_frame_index = index
+        with tracer.stage('render', image=frame):
+            display_image = frame
+            update = self.stream.latest_update()
+            if update is not None and len(update['result']) > 0:
+                labels = [f"cow {i + 1}: {round(self.convertKgToLbs(animal['weight']))} lbs"
+                          for i, animal in enumerate(update['animals'])]
+                display_image = draw_bounding_boxes(display_image, update['result'].boxes,
+                                                    update['result'].confidences, labels)
+        # A new id per frame so QML reloads it, only the last two frames are kept
+        image_id = f"stream_{index}"
+        image_provider.addImage(image_id, self.convert_npy2qimg(display_image))
+        self.stream_image_ids.append(image_id)
+        while len(self.stream_image_ids) > 2:
+            image_provider.discard(self.stream_image_ids.pop(0))
+        self.imageProcessed.emit(image_id)
+
     @Slot()
     def restart_backend(self):
+        self.stop_stream()
+        # Stop the in-flight pipeline before dropping its results
+        self.cancel_pipeline()
+        self.progressChanged.emit("")
         self.input_image = None
         self.processed_image = None
         self.cropped_image = None
@@ -247,25 +595,40 @@ class Backend(QObject):
 
     def prepare_calibration(self) -> bool:
         try:
-            # load mtx, dist from csv
-            self.DistortionCorrection.mtx = np.loadtxt('mtx_05zoom', delimiter=',', dtype=np.float64)
-            self.DistortionCorrection.dist = np.loadtxt('dist_05zoom', delimiter=',', dtype=np.float64)
+            self.pipeline.prepare_calibration()
             return True
             # Return boolean to indicate success
         except Exception as e:
             return False
             # Handle the error appropriately
             
-    def convert_npy2qimg(self, npy_image: np.ndarray) -> QImage:
-        height, width = npy_image.shape[:2]
-        bytesPerLine = 3 * width
-        qImg = QImage(npy_image.data, width, height, bytesPerLine, QImage.Format_RGB888)
-        return qImg
+    """
+        convert_npy2qimg copies a BGR image into a QImage that owns its pixels, so the QImage
+        stays valid after the numpy array is released, also for non-contiguous views
+    """
+    @staticmethod
+    def convert_npy2qimg(npy_image: np.ndarray) -> QImage:
+        with tracer.stage('qimage', image=npy_image):
+            height, width = npy_image.shape[:2]
+            # Format_BGR888 takes the pipeline's color order as is
+            qImg = QImage(width, height, QImage.Format_BGR888)
+            # Write straight into the QImage buffer, rows are padded to bytesPerLine
+            pixels = np.frombuffer(qImg.bits(), dtype=np.uint8, count=qImg.sizeInBytes())
+            pixels = pixels.reshape(height, qImg.bytesPerLine())[:, :3 * width].reshape(height, width, 3)
+            np.copyto(pixels, npy_image)
+            return qImg
+
+    def publish_image(self, image_id, npy_image):
+        image_provider.addImage(image_id, self.convert_npy2qimg(npy_image))
+        # Emit the signal to indicate that the processed image is ready
+        self.imageProcessed.emit(image_id)
+        self.debug_dumper.dump(image_id, npy_image)
 
 
 
     @Slot(str)
     def load_image(self, input_image_path: str):
+        self.stop_stream()
         if input_image_path.startswith("file:///"):
             input_image_path = input_image_path[8:]
         self.input_image_path = Path(input_image_path)
@@ -273,43 +636,51 @@ class Backend(QObject):
         # Should look like 10_s_87_F.jpg
         self.truncated_path = self.input_image_path.parts[-1]
         print(f"Truncated path: {self.truncated_path}")
-        # Split the string by underscore
-        self.truncated_path = self.truncated_path.split('_')
         # Grab the weight part
-        self.actual_weight = float(self.truncated_path[2])
+        _, self.actual_weight, _ = parse_image_name(self.input_image_path)
         print(f"Actual weight: {self.actual_weight}")
         
         
         # Ensure path debugging
         # print(f"Attempting to load image from path: {self.input_image_path}")
         try:
-            
-            self.input_image = cv.imread(str(self.input_image_path))
-            # Ensure image is RGB
-            # If image is not 1900x1425, resize it
-            if self.input_image.shape[0] != 1425 or self.input_image.shape[1] != 1900:
-                self.input_image = cv.resize(self.input_image, (1900, 1425))
-            self.input_image = cv.cvtColor(self.input_image, cv.COLOR_BGR2RGB)
+            # Decode (at reduced scale for large JPEGs) and bring to the 1900x1425 BGR working frame
+            self.input_image = self.pipeline.load(self.input_image_path)
             # Display the self.input_image metadata
             print(f"Image shape: {self.input_image.shape}")  
-              
-            if self.input_image is None:
-                print(f"Failed to load image at {self.input_image_path}")
-            else:
-                # Add the image to the provider
-                qImg = self.convert_npy2qimg(self.input_image)
-                image_provider.addImage("input_img", qImg)
-                # print image metadata from the map
-                print(f"Image metadata: {image_provider.myImageMap['input_img'].size()}")
-                # Emit the signal to indicate that the image is ready
-                self.imageLoaded.emit("input_img")
-                self.imageProcessed.emit("dummy")
+            # Start every stage in the background so next_step only publishes results
+            self.start_pipeline(self.input_image, self.input_image_path)
+            # Add the image to the provider
+            qImg = self.convert_npy2qimg(self.input_image)
+            image_provider.addImage("input_img", qImg)
+            # print image metadata
+            print(f"Image metadata: {qImg.size()}")
+            # Emit the signal to indicate that the image is ready
+            self.imageLoaded.emit("input_img")
+            self.imageProcessed.emit("dummy")
         except Exception as e:
             print(f"Error loading image: {e}")
 
     def convertKgToLbs(self, weight: float) -> float:
         return weight * 2.20462
 
+    def shutdown(self):
+        stream = self.stream
+        self.stop_stream()
+        if stream is not None:
+            # Let the capture thread release the device before the process exits
+            stream.join(timeout=2.0)
+        self.cancel_pipeline()
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        self.model_loader.shutdown(wait=False, cancel_futures=True)
+        if self.inference_client is not None:
+            self.inference_client.close()
+        if self.stage_workers is not None:
+            self.stage_workers.close()
+        self.cache.shutdown()
+        self.timings_timer.stop()
+        self.debug_dumper.shutdown()
+
 
 
 if __name__ == "__main__":
@@ -334,4 +705,7 @@ if __name__ == "__main__":
         sys.stdout.write("Failed to load QML file")
         sys.exit(-1)
 
+    # Stop the background pipeline before the interpreter exits
+    app.aboutToQuit.connect(backend.shutdown)
+
     sys.exit(app.exec())
@@ -110,14 +110,40 @@ ApplicationWindow {
             fileDialog.open()
         }
     }
+    // Streams the camera (or the video picked in the file dialog) through the pipeline
+    Button {
+        id: cameraButton
+        property bool streaming: false
+        text: streaming ? "Stop Stream" : "Start Camera"
+        anchors.horizontalCenter: inputImgPlaceholder.horizontalCenter
+        anchors.top: selectImageButton.bottom
+        anchors.topMargin: 10
+        width: parent.width * 0.3
+        height: parent.height * 0.06
+        Material.background: Material.primary
+        font.pointSize: 18
+
+        onClicked: {
+            if (streaming) {
+                backend.stop_stream()
+            } else {
+                backend.restart_backend()
+                backend.start_stream("") // Default capture device
+            }
+        }
+    }
     FileDialog {
         id: fileDialog
         title: "Select an image"
         currentFolder: StandardPaths.standardLocations(StandardPaths.PicturesLocation)[0]
-        nameFilters: ["Image files (*.jpg *.png)"]
+        nameFilters: ["Image files (*.jpg *.png)", "Video files (*.mp4 *.avi *.mov *.mkv)"]
         onAccepted: {
             // Call the backend to process the image
             var localPath = selectedFile.toString().replace("file:///", "")
+            if (/\.(mp4|avi|mov|mkv)$/i.test(localPath)) {
+                backend.start_stream(localPath)
+                return
+            }
             // Should receive a signal from the backend to update the input image
             console.log("Calling backend to process image")
             backend.load_image(localPath) // Move to next state
@@ -151,6 +177,7 @@ ApplicationWindow {
         Image {
             id: outputImg
             anchors.fill: parent
+            cache: false // Stream frames are shown once, do not keep them in the pixmap cache
             // Use 'imageprovider' as source and append the imageId received
             // from the signal
             anchors.margins: 8
@@ -222,6 +249,54 @@ ApplicationWindow {
         font.family: "Verdana"
 
     }
+    // Per-animal weights when the frame contains more than one cow
+    Text {
+        id: animalWeights
+        font.pointSize: 18
+        anchors.left: outputImgPlaceholder.right
+        anchors.leftMargin: 20
+        anchors.top: outputImgPlaceholder.top
+        color: "white"
+        visible: false
+        font.styleName: "Regular"
+        font.family: "Verdana"
+
+    }
+    // Progress text shown while a step waits on the background pipeline
+    Text {
+        id: progressText
+        font.pointSize: 18
+        anchors.horizontalCenter: parent.horizontalCenter
+        anchors.top: weightPrediction.bottom
+        anchors.topMargin: 10
+        color: "white"
+        text: "Loading models..." // Cleared by onModelsReady
+        visible: progressText.text !== ""
+        font.styleName: "Regular"
+        font.family: "Verdana"
+
+    }
+    // Per-stage latency overlay fed by backend.stageTimings
+    Rectangle {
+        id: timingOverlay
+        anchors.left: parent.left
+        anchors.bottom: parent.bottom
+        anchors.margins: 12
+        width: timingText.implicitWidth + 16
+        height: timingText.implicitHeight + 12
+        radius: 6
+        color: "#99000000"
+        visible: timingText.text !== ""
+
+        Text {
+            id: timingText
+            anchors.centerIn: parent
+            font.family: "Courier New"
+            font.pointSize: 10
+            color: "white"
+            text: ""
+        }
+    }
     // State text to only be displayed after state change
     Text {
         id: stateText
@@ -263,6 +338,7 @@ ApplicationWindow {
                 inputImg.source = "";
                 outputImg.source = "";
                 weightPrediction.visible = false;
+                animalWeights.visible = false;
                 stateText.visible = false;
                 selectImageButton.enabled = true;
                 nextButton.enabled = true;
@@ -276,6 +352,46 @@ ApplicationWindow {
                 nextButton.enabled = false;
 
             }
+            cameraButton.streaming = state == "STREAMING";
+            if (state == "STREAMING") {
+                buttonTimer.stop();
+                nextButton.enabled = false;
+            }
+        }
+        // Models finish loading in the background after the window is shown
+        function onModelsReady() {
+            console.log("Models ready");
+            if (progressText.text === "Loading models...") {
+                progressText.text = "";
+            }
+        }
+        // Show the background pipeline progress, empty text hides it
+        function onProgressChanged(message) {
+            progressText.text = message;
+        }
+        // Show the rolling latency, CPU time, input size and memory growth of every traced stage
+        function onStageTimings(timings) {
+            var stages = JSON.parse(timings);
+            var lines = ["stage               last ms    p50 ms    p99 ms  cpu p50   in MB  rss MB"];
+            for (var name in stages) {
+                var t = stages[name];
+                var rss = t.rss_delta_mean_mb === null ? "-" : t.rss_delta_mean_mb.toFixed(1);
+                lines.push(name.padEnd(18) + t.last_ms.toFixed(1).padStart(9)
+                           + t.p50_ms.toFixed(1).padStart(10) + t.p99_ms.toFixed(1).padStart(10)
+                           + t.cpu_p50_ms.toFixed(1).padStart(9) + t.array_mean_mb.toFixed(1).padStart(8)
+                           + rss.padStart(8));
+            }
+            timingText.text = lines.join("\n");
+        }
+        // List every animal, the bounding boxes are numbered in the same order
+        function onAnimalsPredicted(animals) {
+            var list = JSON.parse(animals);
+            var lines = [];
+            for (var i = 0; i < list.length; i++) {
+                lines.push("Cow " + (i + 1) + ": " + list[i].weight + " lbs");
+            }
+            animalWeights.text = lines.join("\n");
+            animalWeights.visible = list.length > 1;
         }
         // Override weight prediction text with difference in weight text
         function onWeightComparison(weightDifference) {